@@ -1,12 +1,14 @@
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from spicy.core.admin import defaults as admin_defaults
 from spicy.core.admin.conf import AdminAppBase, AdminLink, Perms
 from spicy.core.profile.decorators import is_staff
 from spicy.core.siteskin.decorators import render_to
 from spicy.utils import NavigationFilter
-from . import forms, models
+from . import archive, defaults, export, forms, models, utils
 
 
 class AdminApp(AdminAppBase):
@@ -50,14 +52,30 @@ def actions_list(request):
     if nav.filter_to:
         search_query &= Q(date_joined__lte=nav.filter_to)
 
-    paginator = nav.get_queryset_with_paginator(
-        models.Action, reverse('history:admin:index'),
-        search_query=([search_query], {}),
-        obj_per_page=admin_defaults.ADMIN_OBJECTS_PER_PAGE
-        )
+    if defaults.HISTORY_CURSOR_PAGINATION:
+        paginator = None
+        try:
+            cursor_page = utils.paginate_by_cursor(
+                models.Action.objects.prefetch_consumers().prefetch_related(
+                    'diff_set').filter(search_query), request.GET,
+                admin_defaults.ADMIN_OBJECTS_PER_PAGE,
+                count_limit=defaults.HISTORY_COUNT_LIMIT)
+        except ValueError:
+            raise Http404(unicode(_('Page does not exist.')))
+        objects_list = cursor_page.object_list
+    else:
+        cursor_page = None
+        paginator = nav.get_queryset_with_paginator(
+            models.Action, reverse('history:admin:index'),
+            search_query=([search_query], {}),
+            obj_per_page=admin_defaults.ADMIN_OBJECTS_PER_PAGE
+            )
+        objects_list = models.Action.objects.prefetch(
+            paginator.current_page.object_list)
 
     return {
-        'objects_list': paginator.current_page.object_list,
+        'objects_list': objects_list, 'cursor_page': cursor_page,
+        'use_cursor': cursor_page is not None,
         'paginator': paginator, 'nav': nav, 'form': form,
         'edit_url': 'history:admin:action'}
 
@@ -66,11 +84,90 @@ def actions_list(request):
 @render_to('action.html', use_admin=True)
 def view_action(request, action_id):
     action = models.Action.objects.get(pk=action_id)
-    return {'action': action}
+    diffs = models.Diff.objects.prefetch_neighbours(
+        action.diff_set.select_related('action'))
+    if archive.is_enabled():
+        diffs.extend(archive.get_action_diffs(action))
+    return {'action': action, 'diffs': diffs}
 
 
 @is_staff(required_perms='history.view_history')
 @render_to('diff.html', use_admin=True)
 def view_diff(request, diff_id):
-    diff = models.Diff.objects.get(pk=diff_id)
+    diff = models.Diff.objects.with_neighbours(diff_id)
     return {'diff': diff}
+
+
+@is_staff(required_perms='history.view_history')
+@render_to('blame.html', use_admin=True)
+def blame_diff(request, diff_id):
+    diff = models.Diff.objects.get_with_archived(diff_id)
+    blame = models.Diff.objects.blame(
+        diff.consumer_type_id, diff.consumer_id, diff.field, diff.version)
+    return {'diff': diff, 'blame': blame}
+
+
+@is_staff(required_perms='history.view_history')
+def export_history(request):
+    """
+    Stream history export, filtered by ``consumer_type`` (model name),
+    ``consumer_id``, ``from`` and ``to`` dates of GET parameters.
+    """
+    if not models.Diff.objects.is_denormalized():
+        raise Http404(unicode(_('Run history_denormalize first.')))
+    consumer_type = None
+    if request.GET.get('consumer_type'):
+        try:
+            consumer_type = ContentType.objects.get(
+                model=request.GET['consumer_type'])
+        except ContentType.DoesNotExist:
+            raise Http404(unicode(_('Unknown object type.')))
+    format = request.GET.get('format', 'ndjson')
+    try:
+        consumer_id = request.GET.get('consumer_id')
+        consumer_id = int(consumer_id) if consumer_id else None
+        dates = [
+            request.GET.get(key) and export.parse_date(request.GET[key])
+            for key in ('from', 'to')]
+    except ValueError:
+        raise Http404(unicode(_('Invalid export parameters.')))
+    if format not in export.EXPORT_FORMATS:
+        raise Http404(unicode(_('Unknown export format.')))
+
+    response = StreamingHttpResponse(
+        export.export(
+            format=format, with_text=bool(request.GET.get('text')),
+            **export.get_filters(consumer_type, consumer_id, *dates)),
+        content_type=(
+            'text/csv' if format == 'csv' else 'application/x-ndjson'))
+    response['Content-Disposition'] = (
+        'attachment; filename=history.%s' % format)
+    return response
+
+
+@is_staff(required_perms='history.view_history')
+@render_to('compare.html', use_admin=True)
+def compare_diff(request, diff_id):
+    """
+    Show net changes between version of the diff and the ``version`` or the
+    version current at the ``date`` of GET parameters, or the last version.
+    """
+    diff = models.Diff.objects.get_with_archived(diff_id)
+    try:
+        if request.GET.get('version'):
+            version = int(request.GET['version'])
+        elif request.GET.get('date'):
+            version = models.Diff.objects.get_version_at(
+                diff.consumer_type_id, diff.consumer_id, diff.field,
+                export.parse_date(request.GET['date']))
+        else:
+            version = diff.last_version.version
+    except ValueError:
+        raise Http404(unicode(_('Invalid version.')))
+    from_version, to_version = sorted((diff.version, version))
+    return {
+        'diff': diff, 'from_version': from_version,
+        'to_version': to_version,
+        'change': models.Diff.objects.compare(
+            diff.consumer_type_id, diff.consumer_id, diff.field,
+            from_version, to_version)}
@@ -0,0 +1,322 @@
+"""
+Archive of cold history in compressed append-only segment files.
+
+The history_archive command moves diffs of deleted objects and old versions
+out of the database to segments in HISTORY_ARCHIVE_DIR. Every batch is
+written to a segment of its own before its rows are deleted, and segments of
+a run are merged into one when it ends. Segments are never modified. A
+segment is a single file of:
+
+* zlib compressed JSON records, one per field, holding its archived diffs
+  and snapshots;
+* an index of fixed size entries of diff id and record position, sorted by
+  id;
+* an index of entries of consumer type, consumer id, field hash and record
+  position, sorted by the first three;
+* a footer with offsets of both indexes.
+
+Segments are memory mapped and their indexes are searched with bisection, so
+a lookup reads only the records it needs. A field archived by several runs
+has a record in each of their segments.
+"""
+import bisect
+import datetime
+import heapq
+import json
+import mmap
+import os
+import struct
+import zlib
+from . import defaults
+
+
+SEGMENT_SUFFIX = '.seg'
+
+# Consumer type id, consumer id, field hash, record offset and length.
+KEY_ENTRY = struct.Struct('<IIIQI')
+
+# Diff id, record offset and length.
+ID_ENTRY = struct.Struct('<QQI')
+
+# Offsets of the ids and keys indexes.
+FOOTER = struct.Struct('<QQ')
+
+# Bytes of records copied at once when segments are merged.
+COPY_CHUNK_SIZE = 1 << 20
+
+# Segments by file name, and modification time of the directory they were
+# listed at.
+_segments = {}
+_listed = None
+
+
+def is_enabled():
+    return defaults.HISTORY_ARCHIVE_DIR is not None
+
+
+def hash_field(field):
+    """
+    >>> hash_field('body') == hash_field(u'body')
+    True
+    """
+    return zlib.crc32(field.encode('utf-8')) & 0xffffffff
+
+
+class _Entries(object):
+    """
+    Sequence of fixed size index entries in a part of a buffer, for
+    bisection.
+    """
+    def __init__(self, buf, entry, start, end):
+        self.buf = buf
+        self.entry = entry
+        self.start = start
+        self.length = (end - start) // entry.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.entry.unpack_from(
+            self.buf, self.start + i * self.entry.size)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class Segment(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(self.buf) - FOOTER.size
+        self.data_size, keys_start = FOOTER.unpack_from(self.buf, end)
+        self.ids = _Entries(self.buf, ID_ENTRY, self.data_size, keys_start)
+        self.keys = _Entries(self.buf, KEY_ENTRY, keys_start, end)
+
+    def close(self):
+        self.buf.close()
+
+    def read(self, offset, length):
+        return json.loads(zlib.decompress(self.buf[offset:offset + length]))
+
+    def find(self, *key):
+        """
+        Yield records with keys starting with ``key``, i.e. consumer type,
+        consumer id and field hash.
+        """
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys):
+            entry = self.keys[i]
+            if entry[:len(key)] != key:
+                break
+            yield self.read(*entry[3:])
+            i += 1
+
+    def find_diff(self, diff_id):
+        i = bisect.bisect_left(self.ids, (diff_id,))
+        if i < len(self.ids):
+            entry = self.ids[i]
+            if entry[0] == diff_id:
+                return self.read(*entry[1:])
+
+
+def get_segments():
+    """
+    Return segments of the archive, oldest first. The directory is listed
+    again only once it has changed, opening new segments and closing
+    removed ones.
+    """
+    global _listed
+    mtime = os.stat(defaults.HISTORY_ARCHIVE_DIR).st_mtime
+    if mtime != _listed:
+        names = set(
+            name for name in os.listdir(defaults.HISTORY_ARCHIVE_DIR)
+            if name.endswith(SEGMENT_SUFFIX))
+        for name in set(_segments) - names:
+            _segments.pop(name).close()
+        for name in names - set(_segments):
+            _segments[name] = Segment(
+                os.path.join(defaults.HISTORY_ARCHIVE_DIR, name))
+        _listed = mtime
+    return [_segments[name] for name in sorted(_segments)]
+
+
+def _write(write_data):
+    """
+    Write a new segment with records written by ``write_data(f)``, which
+    returns their ids and keys index entries, and return its file name. The
+    file gets its name once it is complete, so readers never see a partial
+    segment.
+    """
+    global _listed
+    name = 'segment-%s%s' % (
+        datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), SEGMENT_SUFFIX)
+    path = os.path.join(defaults.HISTORY_ARCHIVE_DIR, name)
+    with open(path + '.tmp', 'wb') as f:
+        ids, keys = write_data(f)
+        data_size = f.tell()
+        f.write(''.join(ID_ENTRY.pack(*values) for values in sorted(ids)))
+        keys_start = f.tell()
+        f.write(''.join(KEY_ENTRY.pack(*values) for values in sorted(keys)))
+        f.write(FOOTER.pack(data_size, keys_start))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+    _listed = None
+    return name
+
+
+def write_segment(records):
+    """
+    Write a new segment of ``records``, dicts of ``consumer_type``,
+    ``consumer_id``, ``field``, ``diffs`` (lists of id, action id, version,
+    change and packed change) and ``snapshots`` (lists of version and text).
+    Return its file name, or None if there are no records.
+    """
+    if not records:
+        return
+
+    def write_data(f):
+        ids, keys = [], []
+        for record in records:
+            data = zlib.compress(json.dumps(record))
+            position = f.tell(), len(data)
+            f.write(data)
+            keys.append((
+                record['consumer_type'], record['consumer_id'],
+                hash_field(record['field'])) + position)
+            ids.extend((diff[0],) + position for diff in record['diffs'])
+        return ids, keys
+
+    return _write(write_data)
+
+
+def merge_segments(names):
+    """
+    Replace segments of the given file names with a single one and return
+    its file name. Records are copied as they are.
+    """
+    if len(names) < 2:
+        return names[0] if names else None
+    paths = [
+        os.path.join(defaults.HISTORY_ARCHIVE_DIR, name) for name in names]
+
+    def write_data(f):
+        ids, keys = [], []
+        for path in paths:
+            segment = Segment(path)
+            try:
+                shift = f.tell()
+                for start in xrange(0, segment.data_size, COPY_CHUNK_SIZE):
+                    f.write(segment.buf[start:min(
+                        start + COPY_CHUNK_SIZE, segment.data_size)])
+                ids.extend(
+                    (diff_id, offset + shift, length)
+                    for diff_id, offset, length in segment.ids)
+                keys.extend(
+                    entry[:3] + (entry[3] + shift, entry[4])
+                    for entry in segment.keys)
+            finally:
+                segment.close()
+        return ids, keys
+
+    name = _write(write_data)
+    # Readers may see records of both until the old files are gone.
+    for path in paths:
+        os.remove(path)
+    return name
+
+
+def _make_diff(record, values):
+    from . import models
+    pk, action_id, version, change, packed_change = values
+    diff = models.Diff(
+        pk=pk, action_id=action_id, consumer_type_id=record['consumer_type'],
+        consumer_id=record['consumer_id'], field=record['field'],
+        version=version, change=change, packed_change=packed_change)
+    diff.is_archived = True
+    return diff
+
+
+def get_history(consumer_type_id, consumer_id, field):
+    """
+    Return archived diffs of the field ordered by version, and a dict of its
+    archived snapshot texts by version.
+    """
+    diffs, snapshots = {}, {}
+    for segment in get_segments():
+        for record in segment.find(
+                consumer_type_id, consumer_id, hash_field(field)):
+            if record['field'] != field:
+                continue
+            # Rows archived again after an interrupted run are the same.
+            for values in record['diffs']:
+                diffs[values[2]] = _make_diff(record, values)
+            snapshots.update(record['snapshots'])
+    return [diffs[version] for version in sorted(diffs)], snapshots
+
+
+def iter_history(consumer_type_id, consumer_id, field):
+    """
+    Yield archived diffs of the field ordered by version, reading one record
+    at a time. Later runs archive later versions, so records are met in
+    order of their versions.
+    """
+    last_version = 0
+    for segment in get_segments():
+        for record in segment.find(
+                consumer_type_id, consumer_id, hash_field(field)):
+            if record['field'] != field:
+                continue
+            for values in record['diffs']:
+                # Rows archived again after an interrupted run are the same.
+                if values[2] > last_version:
+                    last_version = values[2]
+                    yield _make_diff(record, values)
+
+
+def iter_fields(consumer_type_id=None, consumer_id=None):
+    """
+    Yield consumer type id, consumer id and field name of archived fields,
+    optionally limited to a consumer type and id.
+    """
+    segments = get_segments()
+    last_key = None
+    for entry in heapq.merge(*[iter(segment.keys) for segment in segments]):
+        key = entry[:3]
+        if key == last_key or (
+                consumer_type_id is not None and key[0] != consumer_type_id or
+                consumer_id is not None and key[1] != consumer_id):
+            continue
+        last_key = key
+        fields = set()
+        for segment in segments:
+            fields.update(record['field'] for record in segment.find(*key))
+        for field in sorted(fields):
+            yield key[:2] + (field,)
+
+
+def get_diff(diff_id):
+    """
+    Return archived diff by id, or None.
+    """
+    for segment in reversed(get_segments()):
+        record = segment.find_diff(diff_id)
+        if record is not None:
+            for values in record['diffs']:
+                if values[0] == diff_id:
+                    return _make_diff(record, values)
+
+
+def get_action_diffs(action):
+    """
+    Return archived diffs made by ``action``.
+    """
+    diffs = {}
+    for segment in get_segments():
+        for record in segment.find(action.consumer_type_id, action.consumer_id):
+            for values in record['diffs']:
+                if values[1] == action.id:
+                    diffs[values[0]] = _make_diff(record, values)
+    return sorted(diffs.values(), key=lambda diff: diff.field)
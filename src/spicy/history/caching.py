@@ -0,0 +1,159 @@
+"""
+Caches of rendered timeline entries and timeline pages.
+
+Rendered entries are keyed by action id, templates version and a generation
+of the consumer, which listeners bump on every save or delete of timeline
+observed objects. Pages are keyed by a generation of their timeline key,
+bumped for old and new keys of changed objects. Blame and comparisons of
+field versions are keyed by a generation of the field, bumped when its
+stored versions are rewritten. Stale values are never read again and expire
+on their own, so invalidation costs one cache write.
+"""
+import hashlib
+import time
+from django.core.cache import get_cache
+from . import defaults
+
+
+CONSUMER_KEY = 'history:consumer:%s:%s'
+
+ENTRY_KEY = 'history:entry:%s:%s:%s'
+
+TIMELINE_KEY = 'history:timeline:%s'
+
+PAGE_KEY = 'history:page:%s'
+
+BLAME_KEY = 'history:blame:%s'
+
+COMPARE_KEY = 'history:compare:%s'
+
+FIELD_KEY = 'history:field:%s:%s:%s'
+
+cache = get_cache(defaults.HISTORY_CACHE_BACKEND)
+
+
+def is_render_cache_enabled():
+    return defaults.HISTORY_RENDER_CACHE_TIMEOUT is not None
+
+
+def is_page_cache_enabled():
+    return defaults.HISTORY_PAGE_CACHE_TIMEOUT is not None
+
+
+def _hash(value):
+    return hashlib.md5(repr(value)).hexdigest()
+
+
+def get_generations(keys):
+    """
+    Return current generations of cache ``keys``. Missing generations start
+    from the current time, so an evicted counter never matches entries
+    cached under its previous values.
+    """
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            generations[key] = int(time.time() * 1000)
+            cache.add(key, generations[key])
+    return generations
+
+
+def bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000))
+
+
+def invalidate_consumer(consumer_type_id, consumer_id):
+    if is_render_cache_enabled():
+        bump_generation(CONSUMER_KEY % (consumer_type_id, consumer_id))
+
+
+def get_entry_keys(actions):
+    """
+    Return a dict of cache keys of rendered ``actions`` by action id.
+    """
+    if not is_render_cache_enabled():
+        return {}
+    generations = get_generations(set(
+        CONSUMER_KEY % (action.consumer_type_id, action.consumer_id)
+        for action in actions))
+    return dict(
+        (action.id, ENTRY_KEY % (
+            action.id, defaults.HISTORY_TEMPLATES_VERSION,
+            generations[CONSUMER_KEY % (
+                action.consumer_type_id, action.consumer_id)]))
+        for action in actions)
+
+
+def get_rendered(keys):
+    """
+    Return a dict of cached rendered entries by action id.
+    """
+    if not keys:
+        return {}
+    cached = cache.get_many(keys.values())
+    return dict(
+        (action_id, cached[key]) for action_id, key in keys.iteritems()
+        if key in cached)
+
+
+def set_rendered(keys, rendered):
+    if keys and rendered:
+        cache.set_many(
+            dict((keys[action_id], html)
+                 for action_id, html in rendered.iteritems()),
+            defaults.HISTORY_RENDER_CACHE_TIMEOUT)
+
+
+def _get_timeline_key(key):
+    return TIMELINE_KEY % _hash(key)
+
+
+def invalidate_timelines(keys):
+    if is_page_cache_enabled():
+        for key in set(keys):
+            bump_generation(_get_timeline_key(key))
+
+
+def get_page_key(consumer_types, key, query):
+    """
+    Return cache key of a timeline page for ``query`` (i.e. request.GET).
+    """
+    timeline_key = _get_timeline_key(key)
+    generation = get_generations([timeline_key])[timeline_key]
+    return PAGE_KEY % _hash((
+        sorted(consumer_types.split(',')), key, generation,
+        sorted(query.items()), defaults.HISTORY_TEMPLATES_VERSION))
+
+
+def set_page(key, context):
+    paginator = context.get('paginator')
+    if paginator is not None:
+        # Only the count of timeline entries is cached with the page.
+        paginator.num_pages
+        paginator.object_list = ()
+    cache.set(key, context, defaults.HISTORY_PAGE_CACHE_TIMEOUT)
+
+
+def _get_field_generation(consumer_type_id, consumer_id, field):
+    key = FIELD_KEY % (consumer_type_id, consumer_id, field)
+    return get_generations([key])[key]
+
+
+def invalidate_field(consumer_type_id, consumer_id, field):
+    bump_generation(FIELD_KEY % (consumer_type_id, consumer_id, field))
+
+
+def get_blame_key(consumer_type_id, consumer_id, field, version):
+    return BLAME_KEY % _hash((
+        consumer_type_id, consumer_id, field, version,
+        _get_field_generation(consumer_type_id, consumer_id, field)))
+
+
+def get_compare_key(
+        consumer_type_id, consumer_id, field, from_version, to_version):
+    return COMPARE_KEY % _hash((
+        consumer_type_id, consumer_id, field, from_version, to_version,
+        _get_field_generation(consumer_type_id, consumer_id, field)))
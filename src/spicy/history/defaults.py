@@ -52,6 +52,12 @@ TIMELINE_FIELDS = {
 
 TIMELINE_PAGE_DAYS = getattr(settings, 'TIMELINE_PAGE_DAYS', 7)
 
+# Attributes of timeline observed models whose attribute timelines have
+# entries of their own, i.e. {'presscenter.Document': ('rubric',)} for
+# /history/document/rubric/1. Timelines of other attributes filter the
+# timeline of the model by current attribute values of objects.
+TIMELINE_ATTRS = getattr(settings, 'TIMELINE_ATTRS', {})
+
 #OBSERVED_FIELDS_LIST = [
 #    u'.'.join((key, value)) for key, value_list in OBSERVED_FIELDS.items()
 #    for value in value_list]
@@ -59,3 +65,81 @@ TIMELINE_PAGE_DAYS = getattr(settings, 'TIMELINE_PAGE_DAYS', 7)
 AUTHORS_TOP_LIMIT = getattr(settings, 'AUTHORS_TOP_LIMIT', 10)
 
 TIMELINE_FEED_DAYS = getattr(settings, 'TIMELINE_FEED_DAYS', 3)
+
+# Full text of a field is stored every HISTORY_SNAPSHOT_INTERVAL versions or
+# when patches accumulated since the previous snapshot exceed
+# HISTORY_SNAPSHOT_PATCH_SIZE characters, so reconstruction never replays
+# the whole chain. Zero disables the corresponding trigger.
+HISTORY_SNAPSHOT_INTERVAL = getattr(settings, 'HISTORY_SNAPSHOT_INTERVAL', 50)
+
+HISTORY_SNAPSHOT_PATCH_SIZE = getattr(
+    settings, 'HISTORY_SNAPSHOT_PATCH_SIZE', 256 * 1024)
+
+# Replay the whole patch chain after each write and compare it with the
+# stored head text. Slow, meant for debugging only.
+HISTORY_VERIFY_PATCHES = getattr(settings, 'HISTORY_VERIFY_PATCHES', False)
+
+# Check context and removed lines of patches while applying them. Turning it
+# off makes reconstruction faster but lets corrupted history go unnoticed.
+HISTORY_STRICT_PATCHES = getattr(settings, 'HISTORY_STRICT_PATCHES', True)
+
+# Store new diffs in a compact encoding without headers and context lines
+# instead of unified diff text. Existing diffs are converted by the
+# history_pack command and read from the text until then.
+HISTORY_PACKED_PATCHES = getattr(settings, 'HISTORY_PACKED_PATCHES', False)
+
+# Only record new field values when an object is saved and compute diffs
+# later with the history_process_pending command.
+HISTORY_ASYNC_CAPTURE = getattr(settings, 'HISTORY_ASYNC_CAPTURE', False)
+
+# Remember hashes of observed field values when objects are loaded and don't
+# compare fields which weren't changed since with their history on save.
+# Fields without any recorded version are still compared, so values set on
+# creation are recorded with the next edit of the object. Values written
+# bypassing model instances (e.g. QuerySet.update) are recorded with the next
+# change of the field itself.
+HISTORY_TRACK_CHANGES = getattr(settings, 'HISTORY_TRACK_CHANGES', False)
+
+# Minutes by app_label.Model within which further edits of an object by the
+# same user amend the diffs of their previous edit instead of adding new
+# versions, e.g. {'presscenter.Document': 10} for autosaved documents. The
+# window starts with the amended edit.
+HISTORY_COALESCE_WINDOWS = getattr(settings, 'HISTORY_COALESCE_WINDOWS', {})
+
+# Paginate timelines and action lists with before/after cursors on date and
+# id instead of page numbers, so deep pages cost the same as the first one.
+HISTORY_CURSOR_PAGINATION = getattr(
+    settings, 'HISTORY_CURSOR_PAGINATION', False)
+
+# Stop counting objects of cursor paginated lists at this number and show it
+# as "more than". None counts all of them.
+HISTORY_COUNT_LIMIT = getattr(settings, 'HISTORY_COUNT_LIMIT', None)
+
+# Cache (an alias from CACHES) for rendered timeline entries.
+HISTORY_CACHE_BACKEND = getattr(settings, 'HISTORY_CACHE_BACKEND', 'default')
+
+# Seconds to keep rendered timeline entries in cache. None turns caching
+# off.
+HISTORY_RENDER_CACHE_TIMEOUT = getattr(
+    settings, 'HISTORY_RENDER_CACHE_TIMEOUT', None)
+
+# Bump after changing provider templates to drop rendered entries.
+HISTORY_TEMPLATES_VERSION = getattr(settings, 'HISTORY_TEMPLATES_VERSION', 1)
+
+# Seconds to keep whole timeline pages for anonymous visitors in cache. None
+# turns caching off.
+HISTORY_PAGE_CACHE_TIMEOUT = getattr(
+    settings, 'HISTORY_PAGE_CACHE_TIMEOUT', None)
+
+# Seconds to keep computed blame of field versions in cache. Versions don't
+# change, so they can be kept long.
+HISTORY_BLAME_CACHE_TIMEOUT = getattr(
+    settings, 'HISTORY_BLAME_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Seconds to keep diffs between pairs of compared versions in cache.
+HISTORY_COMPARE_CACHE_TIMEOUT = getattr(
+    settings, 'HISTORY_COMPARE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Directory of archive segments written by the history_archive command. None
+# turns reading from the archive off.
+HISTORY_ARCHIVE_DIR = getattr(settings, 'HISTORY_ARCHIVE_DIR', None)
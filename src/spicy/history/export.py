@@ -0,0 +1,210 @@
+"""
+Streaming export of recorded history as NDJSON or CSV.
+
+Diffs are read with keyset scans ordered by consumer, field and version, so
+memory use doesn't depend on the size of the history and field text can be
+rebuilt incrementally, one patch per exported version. Diffs moved to the
+archive follow them field by field, then actions without diffs (creations,
+deletions) ordered by id.
+"""
+import csv
+import datetime
+import itertools
+import json
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from . import archive, defaults, models, utils
+
+
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+DATE_FORMAT = '%Y-%m-%d'
+
+COLUMNS = (
+    'action_id', 'action_type', 'date', 'consumer_type', 'consumer_id',
+    'profile_id', 'ip', 'field', 'version', 'change', 'text')
+
+DIFF_KEYS = ('consumer_type', 'consumer_id', 'field', 'version', 'id')
+
+
+def parse_date(value):
+    """
+    Parse a YYYY-MM-DD date. Raise ValueError if it is malformed.
+
+    >>> parse_date('2014-03-28')
+    datetime.datetime(2014, 3, 28, 0, 0)
+    """
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+def get_filters(
+        consumer_type=None, consumer_id=None, date_from=None, date_to=None):
+    """
+    Return filters of exported actions. ``date_to`` is inclusive.
+    """
+    filters = {}
+    if consumer_type is not None:
+        filters['consumer_type'] = consumer_type
+    if consumer_id is not None:
+        filters['consumer_id'] = consumer_id
+    if date_from is not None:
+        filters['date_joined__gte'] = date_from
+    if date_to is not None:
+        filters['date_joined__lt'] = date_to + datetime.timedelta(days=1)
+    return filters
+
+
+def _get_diff_values(diff):
+    return (
+        diff.consumer_type_id, diff.consumer_id, diff.field, diff.version,
+        diff.id)
+
+
+def _make_record(action, consumer_types, diff=None, text=None):
+    consumer_type = consumer_types.get(action.consumer_type_id)
+    if consumer_type is None:
+        consumer_type = consumer_types[action.consumer_type_id] = '.'.join(
+            ContentType.objects.get_for_id(
+                action.consumer_type_id).natural_key())
+    return dict(
+        action_id=action.id, action_type=action.action_type,
+        date=action.date_joined.isoformat(), consumer_type=consumer_type,
+        consumer_id=action.consumer_id, profile_id=action.profile_id,
+        ip=action.ip, field=diff and diff.field,
+        version=diff and diff.version,
+        change=diff and diff.get_change(), text=text)
+
+
+def iter_records(with_text=False, chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """
+    Yield records of actions matching ``filters`` (see ``get_filters``),
+    one per diff. Field text at every exported version is added if
+    ``with_text`` is set.
+    """
+    consumer_types = {}
+    diff_filters = dict(
+        ('action__' + key if key.startswith('date_joined') else key, value)
+        for key, value in filters.iteritems())
+    diffs = utils.iter_keyset(
+        models.Diff.objects.filter(**diff_filters).select_related('action'),
+        DIFF_KEYS, _get_diff_values, chunk_size)
+
+    field_key = lines = version = None
+    for diff in diffs:
+        text = None
+        if with_text:
+            if diff.field_key != field_key or diff.version != version + 1:
+                # Start of a field history, or a gap in it.
+                field_key = diff.field_key
+                text = diff.get_version_text()
+                lines = utils.split_text(text)
+            else:
+                lines = utils.apply_patch(lines, utils.get_patch_ops(
+                    diff.change, diff.packed_change,
+                    defaults.HISTORY_STRICT_PATCHES))
+                text = u'\n'.join(lines)
+            version = diff.version
+        yield _make_record(diff.action, consumer_types, diff, text)
+
+    if archive.is_enabled():
+        consumer_type = filters.get('consumer_type')
+        fields = archive.iter_fields(
+            getattr(consumer_type, 'pk', consumer_type),
+            filters.get('consumer_id'))
+        for field_key in fields:
+            diffs = archive.iter_history(*field_key)
+            lines = []
+            while True:
+                chunk = list(itertools.islice(diffs, chunk_size))
+                if not chunk:
+                    break
+                actions = models.Action.objects.filter(**filters).in_bulk(
+                    set(diff.action_id for diff in chunk))
+                for diff in chunk:
+                    text = None
+                    if with_text:
+                        # Archived versions start from the first one.
+                        lines = utils.apply_patch(
+                            lines, utils.get_patch_ops(
+                                diff.change, diff.packed_change,
+                                defaults.HISTORY_STRICT_PATCHES))
+                        text = u'\n'.join(lines)
+                    if diff.action_id in actions:
+                        yield _make_record(
+                            actions[diff.action_id], consumer_types, diff,
+                            text)
+
+    actions = models.Action.objects.filter(diff__isnull=True, **filters)
+    if archive.is_enabled():
+        actions = _exclude_archived(actions)
+    actions = utils.iter_keyset(
+        actions, ('id',), lambda action: (action.id,), chunk_size)
+    for action in actions:
+        yield _make_record(action, consumer_types)
+
+
+def _exclude_archived(actions):
+    """
+    Exclude edits and rollbacks whose diffs were archived: ones of objects
+    without diffs left in the database, and ones older than the first diff
+    left of a field whose older versions were archived. Such a field has a
+    snapshot without a diff of the same version, which the history_archive
+    command keeps.
+    """
+    qn = connection.ops.quote_name
+    return actions.extra(where=[(
+        '{action}.{action_type} NOT IN (%s, %s) OR '
+        'EXISTS (SELECT 1 FROM {diff} d WHERE '
+        'd.{consumer_type} = {action}.{consumer_type} AND '
+        'd.{consumer_id} = {action}.{consumer_id}) AND '
+        'NOT EXISTS (SELECT 1 FROM {snapshot} s WHERE '
+        's.{consumer_type} = {action}.{consumer_type} AND '
+        's.{consumer_id} = {action}.{consumer_id} AND '
+        'NOT EXISTS (SELECT 1 FROM {diff} d WHERE '
+        'd.{consumer_type} = s.{consumer_type} AND '
+        'd.{consumer_id} = s.{consumer_id} AND d.{field} = s.{field} AND '
+        '(d.{version} = s.{version} OR d.{action_id} < {action}.{id})))'
+        ).format(
+            action=qn(models.Action._meta.db_table),
+            diff=qn(models.Diff._meta.db_table),
+            snapshot=qn(models.Snapshot._meta.db_table),
+            id=qn('id'), action_id=qn('action_id'),
+            action_type=qn('action_type'), field=qn('field'),
+            version=qn('version'), consumer_type=qn('consumer_type_id'),
+            consumer_id=qn('consumer_id'))],
+        params=[defaults.ACTION_EDIT, defaults.ACTION_ROLLBACK])
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+
+def to_ndjson(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def to_csv(records):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for record in records:
+        yield writer.writerow([_encode(record[column]) for column in COLUMNS])
+
+
+def export(format='ndjson', **kwargs):
+    """
+    Return an iterator over chunks of exported history in ``format``.
+    """
+    records = iter_records(**kwargs)
+    if format == 'csv':
+        return to_csv(records)
+    return to_ndjson(records)
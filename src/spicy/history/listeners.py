@@ -1,16 +1,122 @@
 import datetime
 import difflib
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
-from spicy.core.service import api
+from django.db.models.query_utils import DeferredAttribute
 from spicy.core.siteskin.threadlocals import get_current_ip, get_current_user
-from . import defaults, utils
+from . import caching, defaults, registry, timeline, utils
+
+
+BATCH_CHUNK_SIZE = 500
+
+_batch = threading.local()
+
+
+def make_patch(last_value, new_value, consumer_name, last_date, date):
+    return '\n'.join(difflib.unified_diff(
+        utils.split_lines(last_value), utils.split_lines(new_value),
+        consumer_name, consumer_name, last_date, str(date), lineterm=''))
+
+
+def get_today():
+    return datetime.datetime.now().replace(
+        hour=0, minute=0, second=0, microsecond=0)
+
+
+@contextmanager
+def batch():
+    """
+    Buffer history of all observed saves and deletes made in the block and
+    write it with bulk queries on exit. Nested blocks are merged into the
+    outermost one. Nothing is written if the block raises an exception.
+    """
+    if getattr(_batch, 'entries', None) is not None:
+        yield
+        return
+
+    _batch.entries = []
+    _batch.timeline = {}
+    try:
+        yield
+        entries, timeline_states = _batch.entries, _batch.timeline
+    finally:
+        _batch.entries = _batch.timeline = None
+    flush_batch(entries, timeline_states)
+
+
+def track_changes(instance, observation):
+    """
+    Remember hashes of observed field values of ``instance`` to tell which of
+    them are changed when it is saved.
+    """
+    instance._history_hashes = utils.get_field_hashes(
+        instance, observation.tracked_fields)
+
+
+def get_changed_fields(instance, consumer_type, fields, hashes):
+    """
+    Return ``fields`` of ``instance`` whose hashes differ from ``hashes``.
+    Fields which can't be tracked (e.g. properties) or have no recorded
+    version yet are always returned, deferred fields which were never loaded
+    never are.
+    """
+    from . import models
+    new_hashes = instance._history_hashes
+    changed = [
+        field for field in fields if
+        new_hashes.get(field) != hashes.get(field) or
+        field not in new_hashes and not isinstance(
+            getattr(instance.__class__, field, None), DeferredAttribute)]
+    if len(changed) == len(fields):
+        return changed
+
+    recorded = getattr(instance, '_history_recorded', None)
+    if recorded is None:
+        recorded = instance._history_recorded = set(
+            models.Head.objects.filter(
+                consumer_type=consumer_type, consumer_id=instance.pk,
+                version__gt=0).values_list('field', flat=True))
+    return [
+        field for field in fields if field in changed or (
+            field not in recorded and field in new_hashes)]
+
+
+def object_post_init(sender, **kwargs):
+    track_changes(kwargs.get('instance'), registry.get(sender))
 
 
-@transaction.commit_on_success
 def object_post_save(sender, **kwargs):
-    sender_name = '.'.join((sender._meta.app_label, sender._meta.object_name))
-    
+    instance = kwargs.get('instance')
+    if getattr(instance, '_action_type', None) == defaults.ACTION_ROLLBACK:
+        # History of a rollback is written by the rollback itself, within
+        # its own transaction.
+        del instance._action_type
+        if hasattr(instance, '_history_hashes'):
+            track_changes(instance, registry.get(sender))
+    else:
+        record_save(sender, **kwargs)
+
+    if not registry.get(sender).is_timeline:
+        return
+    consumer_type_id = ContentType.objects.get_for_model(sender).id
+    if getattr(_batch, 'entries', None) is None:
+        timeline.update(instance)
+    else:
+        _batch.timeline[consumer_type_id, instance.pk] = (
+            timeline.get_state(instance))
+    caching.invalidate_consumer(consumer_type_id, instance.pk)
+
+
+@transaction.commit_on_success
+def record_save(sender, **kwargs):
+    """
+    Record history of a saved object: write its action and diffs, buffer
+    them in a batch or queue them for asynchronous processing.
+    """
     from . import models
     instance = kwargs.get('instance')
 
@@ -23,25 +129,66 @@ def object_post_save(sender, **kwargs):
             defaults.ACTION_CREATE if kwargs.get('created') else
             defaults.ACTION_EDIT)
 
-    if action_type == defaults.ACTION_ROLLBACK:
-        return
-
-    timeline_observed = utils.is_observed(sender_name, action_type)
-    if not ((sender_name in defaults.OBSERVED_FIELDS) or
-            timeline_observed):
+    observation = registry.get(sender)
+    hashes = getattr(instance, '_history_hashes', None)
+    if hashes is not None:
+        track_changes(instance, observation)
+    if not observation.is_observed(action_type):
         return
 
     profile = get_current_user()
     if profile and profile.is_anonymous():
         profile = None
 
+    fields = observation.get_fields(action_type)
+    if hashes is not None and action_type == defaults.ACTION_CREATE:
+        instance._history_recorded = set()
+    elif hashes is not None:
+        # Only fields changed since the object was loaded or last saved can
+        # differ from their history, once it has any.
+        fields = get_changed_fields(instance, consumer_type, fields, hashes)
+        if not fields and action_type == defaults.ACTION_EDIT:
+            return
+        if hasattr(instance, '_history_recorded'):
+            instance._history_recorded.update(fields)
+
+    entries = getattr(_batch, 'entries', None)
+    if entries is not None:
+        entries.append(dict(
+            consumer_type=consumer_type, consumer_id=instance.pk,
+            consumer_name=unicode(instance).encode('utf-8'),
+            action_type=action_type, profile=profile, ip=get_current_ip(),
+            ignore_in_timeline=getattr(instance, '_ignore_in_timeline', False),
+            values=dict(
+                (field, utils.to_unicode(
+                    getattr(instance, field)).encode('utf-8'))
+                for field in fields
+            ) if action_type != defaults.ACTION_CREATE else {}))
+        if action_type == defaults.ACTION_CREATE:
+            instance._ignore_in_timeline = True
+        return
+
+    if (action_type == defaults.ACTION_EDIT and profile is not None and
+            observation.coalesce_window and
+            not defaults.HISTORY_ASYNC_CAPTURE):
+        provider = get_coalesced_action(
+            consumer_type, instance.pk, profile, observation.coalesce_window)
+        if provider is not None:
+            amended = amend_diffs(
+                provider, unicode(instance).encode('utf-8'), dict(
+                    (field, utils.to_unicode(
+                        getattr(instance, field)).encode('utf-8'))
+                    for field in fields))
+            if amended is not None:
+                if not amended:
+                    provider.delete()
+                return
+
     if action_type == defaults.ACTION_EDIT:
-        today = datetime.datetime.now().replace(
-            hour=0, minute=0, second=0, microsecond=0)
         if models.Action.objects.filter(
                 consumer_type=consumer_type, consumer_id=instance.pk,
                 action_type__in=(defaults.ACTION_CREATE, defaults.ACTION_EDIT),
-                date_joined__gte=today).exists():
+                date_joined__gte=get_today()).exists():
             instance._ignore_in_timeline = True
     provider = models.Action.objects.create(
         consumer_type=consumer_type, consumer_id=instance.pk,
@@ -52,76 +199,301 @@ def object_post_save(sender, **kwargs):
         instance._ignore_in_timeline = True
         return
 
-    fields = (
-        set(defaults.OBSERVED_FIELDS.get(sender_name, ())) |
-        set(defaults.TIMELINE_FIELDS.get(sender_name, ())
-            if timeline_observed else ()))
-    if fields:
-        consumer_name = unicode(provider.consumer).encode('utf-8')
+    consumer_name = unicode(instance).encode('utf-8')
+    values = dict(
+        (field, utils.to_unicode(getattr(instance, field)).encode('utf-8'))
+        for field in fields)
+
+    if defaults.HISTORY_ASYNC_CAPTURE:
+        models.PendingChange.objects.create(
+            action=provider, consumer_name=consumer_name.decode('utf-8'),
+            values=json.dumps(values))
+        return
+
+    if (not write_diffs(provider, consumer_name, values) and
+            action_type == defaults.ACTION_EDIT):
+        provider.delete()
 
+
+def write_diffs(provider, consumer_name, values):
+    """
+    Write diffs of new field ``values`` made by ``provider`` action and
+    return True if any field has changed.
+    """
+    from . import models
     has_diff = False
-            
-    for field in fields:
-        last_version = api.register['history'].get_last_version(
-            sender._meta.module_name, instance.pk, field)
-        if last_version > 0:
-            diffs = models.Diff.objects.filter(
-                action__consumer_type=consumer_type,
-                action__consumer_id=instance.pk, field=field,
-                version=last_version)
-            if len(diffs) > 1:
-                for diff in diffs[1:]:
-                    diff.delete()
-            last_diff = diffs[0]
-            last_value = last_diff.get_version_text().encode('utf-8')
-        else:
-            last_value = ''
-        new_value = utils.to_unicode(getattr(instance, field)).encode('utf-8')
+
+    for field, new_value in values.iteritems():
+        head = models.Head.objects.get_for(
+            provider.consumer_type_id, provider.consumer_id, field,
+            for_update=True)
+        last_value = head.text.encode('utf-8')
 
         if last_value != new_value:
-            try:
-                last_action = models.Action.objects.filter(
-                    diff__version=last_version, diff__field=field,
-                    consumer_type__model=sender._meta.module_name,
-                    consumer_id=instance.pk)[0]
-                last_date = last_action.date_joined
-            except IndexError:
-                last_date = ''
-                last_value = ''
-             
-            patch = '\n'.join(difflib.unified_diff(
-                last_value.splitlines(), new_value.splitlines(),
-                consumer_name, consumer_name, last_date,
-                str(provider.date_joined), lineterm=''))
+            patch = make_patch(
+                last_value, new_value, consumer_name, head.date or '',
+                provider.date_joined)
 
             if patch:
                 has_diff = True
             else:
                 continue
 
-            new_version = last_version + 1
-            diff = models.Diff.objects.create(
-                action=provider, version=new_version, field=field,
-                change=patch)
-
-            # Make sure that we can get latest version without errors.
-            diff = models.Diff.objects.get(
-                action__consumer_type=consumer_type,
-                action__consumer_id=instance.pk, field=field,
-                version=new_version)
-            diff.get_version_text()
-    if not has_diff and action_type == defaults.ACTION_EDIT:
-        provider.delete()
+            diff = provider.make_diff(field, head.version + 1, patch)
+            diff.save()
+            head.advance(diff, utils.join_lines(new_value).decode('utf-8'))
+    return has_diff
+
+
+def get_coalesced_action(consumer_type, consumer_id, profile, window):
+    """
+    Return the last action of the consumer if it's an edit made by
+    ``profile`` within ``window`` which no rollback refers to, so the next
+    edit can amend it.
+    """
+    from . import models
+    try:
+        action = models.Action.objects.filter(
+            consumer_type=consumer_type, consumer_id=consumer_id
+            ).order_by('-id')[0]
+    except IndexError:
+        return
+    if (action.action_type == defaults.ACTION_EDIT and
+            action.profile_id == profile.pk and
+            action.date_joined >= datetime.datetime.now() - window and
+            not models.Action.objects.filter(
+                rollback_to__action=action).exists()):
+        return action
+
+
+def amend_diffs(provider, consumer_name, values):
+    """
+    Recompute diffs of ``provider``, the last action of its consumer, from
+    the versions preceding them to new field ``values``, so the field
+    versions it made end up with these values. Fields which it didn't change
+    get new diffs. Return True if the action still changes anything, or None
+    without changing it if a field has versions after the one it made.
+    """
+    from . import models
+    diffs = dict((diff.field, diff) for diff in provider.diff_set.all())
+
+    heads = {}
+    for field in values:
+        heads[field] = models.Head.objects.get_for(
+            provider.consumer_type_id, provider.consumer_id, field,
+            for_update=True)
+        # An action has a single diff of a field, so a later version can't
+        # be added to it.
+        if field in diffs and diffs[field].version != heads[field].version:
+            return
+
+    for field, new_value in values.iteritems():
+        head = heads[field]
+        diff = diffs.get(field)
+        if diff is None:
+            write_diffs(provider, consumer_name, {field: new_value})
+            continue
+
+        previous = diff.prev_version
+        if previous is None:
+            last_text, snapshot_version, patch_size = u'', 0, 0
+            last_date = ''
+        else:
+            last_text, snapshot_version, patch_size = previous.reconstruct()
+            last_date = previous.action.date_joined
+        last_value = last_text.encode('utf-8')
+
+        # Snapshots of the amended version no longer match it.
+        models.Snapshot.objects.filter(
+            consumer_type__id=provider.consumer_type_id,
+            consumer_id=provider.consumer_id, field=field,
+            version__gte=diff.version).delete()
+        caching.invalidate_field(
+            provider.consumer_type_id, provider.consumer_id, field)
+
+        if utils.split_lines(last_value) == utils.split_lines(new_value):
+            # The edit is undone, so is the version. Deleting the diff
+            # deletes the head too; it's built again from the history.
+            diff.delete()
+            models.Head.objects.get_for(
+                provider.consumer_type_id, provider.consumer_id, field)
+            continue
+
+        diff.set_change(make_patch(
+            last_value, new_value, consumer_name, last_date,
+            provider.date_joined))
+        diff.save()
+        head.version = diff.version - 1
+        head.snapshot_version, head.patch_size = snapshot_version, patch_size
+        head.advance(diff, utils.join_lines(new_value).decode('utf-8'))
+    return provider.diff_set.exists()
+
+
+def process_pending(pending_changes):
+    """
+    Write diffs for pending changes recorded by asynchronous capture, in
+    the order they were saved. Each change is written in its own
+    transaction and removed from the queue once done.
+    """
+    from . import models
+    processed = 0
+    for pending in pending_changes:
+        with transaction.commit_on_success():
+            # Another worker may have taken the change since it was listed.
+            pending = list(
+                models.PendingChange.objects.select_for_update(
+                    ).select_related('action').filter(pk=pending.pk))
+            if not pending:
+                continue
+            pending = pending[0]
+            provider = pending.action
+            values = dict(
+                (field, value.encode('utf-8'))
+                for field, value in json.loads(pending.values).iteritems())
+            if (not write_diffs(
+                    provider, pending.consumer_name.encode('utf-8'),
+                    values) and
+                    provider.action_type == defaults.ACTION_EDIT):
+                provider.delete()
+            else:
+                pending.delete()
+        caching.invalidate_consumer(
+            provider.consumer_type_id, provider.consumer_id)
+        processed += 1
+    return processed
 
 
 def object_pre_delete(sender, **kwargs):
-    sender_name = '.'.join((sender._meta.app_label, sender._meta.object_name))
-    if (
-            (sender_name in defaults.OBSERVED_FIELDS) or
-            utils.is_observed(sender_name, defaults.ACTION_DELETE)):
-        from . import models
-        instance = kwargs.get('instance')
-        models.Action.objects.create(
-            consumer_type=ContentType.objects.get_for_model(sender),
-            consumer_id=instance.pk, action_type=defaults.ACTION_DELETE,
-            profile=get_current_user(), ip=get_current_ip())
+    from . import models
+    observation = registry.get(sender)
+    instance = kwargs.get('instance')
+    consumer_type = ContentType.objects.get_for_model(sender)
+    if observation.is_timeline:
+        timeline.remove(instance)
+        caching.invalidate_consumer(consumer_type.id, instance.pk)
+        states = getattr(_batch, 'timeline', None)
+        if states is not None:
+            # The batch must not bring back entries of a deleted object.
+            states.pop((consumer_type.id, instance.pk), None)
+    if not observation.is_observed(defaults.ACTION_DELETE):
+        return
+
+    entries = getattr(_batch, 'entries', None)
+    if entries is not None:
+        entries.append(dict(
+            consumer_type=consumer_type, consumer_id=instance.pk,
+            action_type=defaults.ACTION_DELETE,
+            profile=get_current_user(), ip=get_current_ip(),
+            ignore_in_timeline=False, values={}))
+        return
+    models.Action.objects.create(
+        consumer_type=consumer_type,
+        consumer_id=instance.pk, action_type=defaults.ACTION_DELETE,
+        profile=get_current_user(), ip=get_current_ip())
+
+
+def _chunks(values, size=BATCH_CHUNK_SIZE):
+    values = list(values)
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+@transaction.commit_on_success
+def flush_batch(entries, timeline_states):
+    """
+    Write buffered history entries in the order they were recorded, producing
+    the same versions and timeline flags as saving them one by one would.
+    Then sync timeline entries using states of objects at their last save.
+    """
+    from . import models
+
+    consumer_ids = defaultdict(set)
+    for entry in entries:
+        consumer_ids[entry['consumer_type'].id].add(entry['consumer_id'])
+
+    # Objects created or edited today before the batch don't go to timeline
+    # again.
+    edited = set()
+    heads = {}
+    for consumer_type_id, ids in consumer_ids.iteritems():
+        for chunk in _chunks(ids):
+            edited.update(models.Action.objects.filter(
+                consumer_type__id=consumer_type_id, consumer_id__in=chunk,
+                action_type__in=(defaults.ACTION_CREATE, defaults.ACTION_EDIT),
+                date_joined__gte=get_today()
+                ).values_list('consumer_type', 'consumer_id'))
+            heads.update(
+                ((head.consumer_type_id, head.consumer_id, head.field), head)
+                for head in models.Head.objects.select_for_update().filter(
+                    consumer_type__id=consumer_type_id,
+                    consumer_id__in=chunk))
+
+    diffs = []
+    snapshots = []
+    changed_heads = {}
+    for entry in entries:
+        consumer_type = entry['consumer_type']
+        consumer_key = consumer_type.id, entry['consumer_id']
+
+        changes = []
+        for field, new_value in entry['values'].iteritems():
+            key = consumer_key + (field,)
+            head = heads.get(key)
+            if head is None:
+                head = heads[key] = models.Head.objects.get_for(
+                    *key, for_update=True)
+            last_value = head.text.encode('utf-8')
+            if utils.split_lines(last_value) != utils.split_lines(new_value):
+                changes.append((head, field, last_value, new_value))
+
+        action_type = entry['action_type']
+        if action_type == defaults.ACTION_EDIT and not changes:
+            continue
+
+        ignore_in_timeline = entry['ignore_in_timeline'] or (
+            action_type == defaults.ACTION_EDIT and consumer_key in edited)
+        provider = models.Action.objects.create(
+            consumer_type=consumer_type, consumer_id=entry['consumer_id'],
+            action_type=action_type, profile=entry['profile'],
+            ip=entry['ip'], show_in_timeline=not ignore_in_timeline)
+        if action_type in (defaults.ACTION_CREATE, defaults.ACTION_EDIT):
+            edited.add(consumer_key)
+
+        for head, field, last_value, new_value in changes:
+            diff = provider.make_diff(
+                field, head.version + 1, make_patch(
+                    last_value, new_value, entry['consumer_name'],
+                    head.date or '', provider.date_joined))
+            diffs.append(diff)
+            snapshot = head.advance(
+                diff, utils.join_lines(new_value).decode('utf-8'),
+                commit=False)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+            changed_heads[
+                head.consumer_type_id, head.consumer_id, head.field] = head
+
+    models.Diff.objects.bulk_create(diffs)
+    models.Snapshot.objects.bulk_create(snapshots)
+    changed_heads = changed_heads.values()
+
+    # bulk_create doesn't set primary keys, so diffs are fetched back to
+    # point heads at them.
+    diff_ids = {}
+    for chunk in _chunks(set(head.diff.action_id for head in changed_heads)):
+        diff_ids.update(
+            ((action_id, field), pk) for action_id, field, pk in
+            models.Diff.objects.filter(action__in=chunk).values_list(
+                'action', 'field', 'pk'))
+    for head in changed_heads:
+        head.diff.pk = head.diff_id = diff_ids[
+            head.diff.action_id, head.field]
+    for chunk in _chunks(head.pk for head in changed_heads):
+        models.Head.objects.filter(pk__in=chunk).delete()
+    models.Head.objects.bulk_create(changed_heads)
+    for head in changed_heads:
+        head.verify()
+
+    for (consumer_type_id, consumer_id), (keys, is_public) in (
+            timeline_states.iteritems()):
+        timeline.sync(consumer_type_id, consumer_id, keys, is_public)
@@ -0,0 +1,165 @@
+import datetime
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Min
+from spicy.history import archive, caching, defaults, models, utils
+
+
+class Command(BaseCommand):
+    help = (
+        'Move diffs of deleted objects and versions older than the given age '
+        'to compressed segment files in HISTORY_ARCHIVE_DIR. The last version '
+        'of a live object, rollback targets and versions after them stay in '
+        'the database, and a snapshot is kept at the last archived version. '
+        'Every batch is written to a new segment before its rows are '
+        'deleted, so an interrupted run can be repeated. Segments of a run '
+        'are merged into one at its end.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--days', dest='days', type='int', default=365,
+            help='Archive versions older than this number of days.'),
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of fields archived to one segment.'),
+        make_option(
+            '--sleep', dest='sleep', type='float', default=0,
+            help='Seconds to wait between batches.'),
+    )
+
+    def handle(self, *args, **options):
+        if not archive.is_enabled():
+            raise CommandError('HISTORY_ARCHIVE_DIR is not set.')
+        if not models.Diff.objects.is_denormalized():
+            raise CommandError('Run history_denormalize first.')
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            days=options['days'])
+        self.archived = 0
+        self.segments = []
+
+        # History of deleted objects goes first, whatever its age.
+        deleted = utils.iter_keyset(
+            models.Action.objects.filter(
+                action_type=defaults.ACTION_DELETE).values_list(
+                    'consumer_type', 'consumer_id').distinct(),
+            ('consumer_type', 'consumer_id'), lambda key: key,
+            options['batch_size'])
+        batch = []
+        for consumer_type_id, consumer_id in deleted:
+            batch.extend(
+                (consumer_type_id, consumer_id, field, True)
+                for field in models.Diff.objects.filter(
+                    consumer_type__id=consumer_type_id,
+                    consumer_id=consumer_id).values_list(
+                        'field', flat=True).distinct())
+            if len(batch) >= options['batch_size']:
+                self.archive(batch, cutoff, options['sleep'])
+                batch = []
+        self.archive(batch, cutoff, options['sleep'])
+
+        keys = utils.iter_keyset(
+            models.Diff.objects.filter(
+                action__date_joined__lt=cutoff).values_list(
+                    'consumer_type', 'consumer_id', 'field').distinct(),
+            ('consumer_type', 'consumer_id', 'field'), lambda key: key,
+            options['batch_size'])
+        batch = []
+        for key in keys:
+            batch.append(key + (False,))
+            if len(batch) == options['batch_size']:
+                self.archive(batch, cutoff, options['sleep'])
+                batch = []
+        self.archive(batch, cutoff, options['sleep'])
+        archive.merge_segments(self.segments)
+
+    def archive(self, batch, cutoff, sleep):
+        records = filter(None, (
+            self.get_record(cutoff, *key) for key in batch))
+        name = archive.write_segment(records)
+        if name is not None:
+            self.segments.append(name)
+        for record in records:
+            with transaction.commit_on_success():
+                self.remove(record)
+            self.archived += len(record['diffs'])
+        if records:
+            self.stdout.write('Archived %d diffs\n' % self.archived)
+            if sleep:
+                time.sleep(sleep)
+
+    def get_record(
+            self, cutoff, consumer_type_id, consumer_id, field, is_deleted):
+        """
+        Return a record of archived history of the field, or None if nothing
+        is to be archived.
+        """
+        key = dict(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field)
+        last_version = None
+        target = models.Action.objects.filter(
+            rollback_to__consumer_type__id=consumer_type_id,
+            rollback_to__consumer_id=consumer_id,
+            rollback_to__field=field).aggregate(
+                version=Min('rollback_to__version'))['version']
+        if not is_deleted:
+            last_version = models.Head.objects.get_for(
+                consumer_type_id, consumer_id, field).version
+
+        diffs = []
+        for values in models.Diff.objects.filter(**key).order_by(
+                'version').values_list(
+                    'pk', 'action', 'version', 'change', 'packed_change',
+                    'action__date_joined').iterator():
+            version, date_joined = values[2], values[5]
+            if (target is not None and version >= target or
+                    not is_deleted and (
+                        version >= last_version or date_joined >= cutoff)):
+                break
+            diffs.append(values[:5])
+        if not diffs:
+            return
+
+        version = diffs[-1][2]
+        return dict(
+            consumer_type=consumer_type_id, consumer_id=consumer_id,
+            field=field, diffs=diffs,
+            snapshots=list(models.Snapshot.objects.filter(
+                version__lte=version, **key).values_list(
+                    'version', 'text')))
+
+    def remove(self, record):
+        """
+        Delete archived diffs and snapshots of the record from the database,
+        keeping a snapshot of the last archived version if later ones stay.
+        """
+        consumer_type_id, consumer_id, field = (
+            record['consumer_type'], record['consumer_id'], record['field'])
+        key = dict(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field)
+        # Saves of the object wait for the archiving of its field.
+        list(models.Head.objects.select_for_update().filter(**key))
+        version = record['diffs'][-1][2]
+        is_complete = not models.Diff.objects.filter(
+            version__gt=version, **key).exists()
+        if not is_complete and not models.Snapshot.objects.filter(
+                version=version, **key).exists():
+            models.Snapshot.objects.create(
+                consumer_type_id=consumer_type_id, consumer_id=consumer_id,
+                field=field, version=version, text=models.Diff(
+                    version=version, consumer_type_id=consumer_type_id,
+                    consumer_id=consumer_id, field=field).get_version_text())
+
+        if is_complete:
+            models.Head.objects.filter(**key).delete()
+            models.Snapshot.objects.filter(**key).delete()
+        else:
+            models.Snapshot.objects.filter(
+                version__lt=version, **key).delete()
+        ids = [values[0] for values in record['diffs']]
+        for i in xrange(0, len(ids), 500):
+            models.Diff.objects.filter(pk__in=ids[i:i + 500]).delete()
+        caching.invalidate_field(consumer_type_id, consumer_id, field)
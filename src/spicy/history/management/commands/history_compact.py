@@ -0,0 +1,145 @@
+import datetime
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from spicy.history import caching, defaults, listeners, models, utils
+
+
+class Command(BaseCommand):
+    args = '[app_label.Model ...]'
+    help = (
+        'Squash runs of consecutive field versions older than the retention '
+        'age into their last version, optionally limited to the given '
+        'models. Versions keep their numbers, so squashed ones leave gaps. '
+        'Rollback targets and snapshot versions are kept. Every field is '
+        'compacted in its own transaction and compacting it again changes '
+        'nothing, so the command can be stopped and run again at any time.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--days', dest='days', type='int', default=365,
+            help='Squash versions older than this number of days.'),
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of fields compacted between pauses.'),
+        make_option(
+            '--sleep', dest='sleep', type='float', default=0,
+            help='Seconds to wait between batches.'),
+    )
+
+    def handle(self, *labels, **options):
+        if not models.Diff.objects.is_denormalized():
+            raise CommandError('Run history_denormalize first.')
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            days=options['days'])
+        diffs = models.Diff.objects.filter(action__date_joined__lt=cutoff)
+        if labels:
+            ctypes = []
+            for label in labels:
+                try:
+                    app_label, model = label.split('.')
+                    ctypes.append(ContentType.objects.get(
+                        app_label=app_label, model=model.lower()))
+                except (ValueError, ContentType.DoesNotExist):
+                    raise CommandError('Unknown model: %s' % label)
+            diffs = diffs.filter(consumer_type__in=ctypes)
+
+        keys = utils.iter_keyset(
+            diffs.values_list('consumer_type', 'consumer_id', 'field'
+                              ).distinct(),
+            ('consumer_type', 'consumer_id', 'field'), lambda key: key,
+            options['batch_size'])
+
+        fields = squashed = 0
+        for key in keys:
+            with transaction.commit_on_success():
+                squashed += self.compact(cutoff, *key)
+            fields += 1
+            if not fields % options['batch_size']:
+                self.stdout.write(
+                    'Compacted %d fields, squashed %d versions\n' % (
+                        fields, squashed))
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+        self.stdout.write(
+            'Compacted %d fields, squashed %d versions\n' % (
+                fields, squashed))
+
+    def compact(self, cutoff, consumer_type_id, consumer_id, field):
+        """
+        Squash versions of the field older than ``cutoff`` and return the
+        number of deleted diffs.
+        """
+        # Saves of the object wait for the compaction of its field.
+        head = models.Head.objects.get_for(
+            consumer_type_id, consumer_id, field, for_update=True)
+        key = dict(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field)
+        kept = set(models.Snapshot.objects.filter(**key).values_list(
+            'version', flat=True))
+        kept.update(models.Action.objects.filter(
+            rollback_to__consumer_type__id=consumer_type_id,
+            rollback_to__consumer_id=consumer_id,
+            rollback_to__field=field).values_list(
+                'rollback_to__version', flat=True))
+        diffs = models.Diff.objects.filter(**key).order_by(
+            'version').values_list(
+                'pk', 'version', 'change', 'packed_change',
+                'action__date_joined')
+
+        squashed = 0
+        lines = date = None
+        run, start = [], None
+        for pk, version, change, packed_change, date_joined in (
+                diffs.iterator()):
+            if date_joined >= cutoff:
+                break
+            if lines is None:
+                lines, date = [], ''
+                if version > 1:
+                    # Versions below the first one left may be archived.
+                    lines = utils.split_text(models.Diff(
+                        consumer_type_id=consumer_type_id,
+                        consumer_id=consumer_id, field=field,
+                        version=version - 1).get_version_text())
+            if not run:
+                start = lines, date
+            lines = utils.apply_patch(lines, utils.get_patch_ops(
+                change, packed_change, defaults.HISTORY_STRICT_PATCHES))
+            date = date_joined
+            run.append(pk)
+            if version in kept:
+                squashed += self.squash(run, start, (lines, date))
+                run = []
+        squashed += self.squash(run, start, (lines, date))
+
+        if squashed:
+            caching.invalidate_field(consumer_type_id, consumer_id, field)
+            # Patches replayed since the last snapshot have changed.
+            head.patch_size = sum(
+                len(packed_change or change)
+                for change, packed_change in models.Diff.objects.filter(
+                    version__gt=head.snapshot_version, **key
+                    ).values_list('change', 'packed_change').iterator())
+            head.save()
+        return squashed
+
+    def squash(self, run, start, end):
+        """
+        Replace diffs of the ``run`` with a single patch from the ``start``
+        lines and date before it to the ``end`` ones, stored in the last one.
+        """
+        if len(run) < 2:
+            return 0
+        (old_lines, old_date), (new_lines, new_date) = start, end
+        diff = models.Diff()
+        diff.set_change(listeners.make_patch(
+            u'\n'.join(old_lines).encode('utf-8'),
+            u'\n'.join(new_lines).encode('utf-8'), '', old_date, new_date))
+        models.Diff.objects.filter(pk=run[-1]).update(
+            change=diff.change, packed_change=diff.packed_change)
+        models.Diff.objects.filter(pk__in=run[:-1]).delete()
+        return len(run) - 1
@@ -0,0 +1,53 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+from spicy.history import models
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy consumer type and id from actions to diffs which were stored '
+        'before these columns were added. Runs in small batches of primary '
+        'keys, so it can be used on a live table. Until it is done, diffs of '
+        'an object are filled when its history is read, and maintenance '
+        'commands refuse to run.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=5000,
+            help='Range of diff ids updated in one transaction.'),
+        make_option(
+            '--sleep', dest='sleep', type='float', default=0,
+            help='Seconds to wait between batches.'),
+    )
+
+    def handle(self, *args, **options):
+        qn = connection.ops.quote_name
+        diff_table = qn(models.Diff._meta.db_table)
+        action_table = qn(models.Action._meta.db_table)
+        sql = (
+            'UPDATE {diff} SET '
+            '{consumer_type} = (SELECT {consumer_type} FROM {action} '
+            'WHERE {action}.{id} = {diff}.{action_id}), '
+            '{consumer_id} = (SELECT {consumer_id} FROM {action} '
+            'WHERE {action}.{id} = {diff}.{action_id}) '
+            'WHERE {diff}.{id} > %s AND {diff}.{id} <= %s AND '
+            '{diff}.{consumer_type} IS NULL').format(
+                diff=diff_table, action=action_table, id=qn('id'),
+                action_id=qn('action_id'),
+                consumer_type=qn('consumer_type_id'),
+                consumer_id=qn('consumer_id'))
+
+        last_pk = models.Diff.objects.aggregate(Max('pk'))['pk__max'] or 0
+        updated = 0
+        for start in xrange(0, last_pk, options['batch_size']):
+            with transaction.commit_on_success():
+                cursor = connection.cursor()
+                cursor.execute(sql, [start, start + options['batch_size']])
+                transaction.set_dirty()
+                updated += cursor.rowcount
+            self.stdout.write('Updated %d diffs\n' % updated)
+            if options['sleep']:
+                time.sleep(options['sleep'])
@@ -0,0 +1,72 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db import models as db_models
+from spicy.history import export, models
+
+
+class Command(BaseCommand):
+    help = (
+        'Export history of actions and diffs, optionally limited to a model, '
+        'an object or a date range. Diffs must have been denormalized by '
+        'history_denormalize.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--model', dest='model', default=None,
+            help='Export history of app_label.Model only.'),
+        make_option(
+            '--consumer-id', dest='consumer_id', type='int', default=None,
+            help='Export history of the object with this id only.'),
+        make_option(
+            '--from', dest='date_from', default=None,
+            help='Export actions made on or after YYYY-MM-DD.'),
+        make_option(
+            '--to', dest='date_to', default=None,
+            help='Export actions made on or before YYYY-MM-DD.'),
+        make_option(
+            '--format', dest='format', default='ndjson',
+            choices=export.EXPORT_FORMATS,
+            help='Output format: ndjson or csv.'),
+        make_option(
+            '--text', dest='with_text', action='store_true', default=False,
+            help='Add field text at every exported version.'),
+        make_option(
+            '--output', dest='output', default=None,
+            help='Write to this file instead of the standard output.'),
+    )
+
+    def handle(self, *args, **options):
+        if not models.Diff.objects.is_denormalized():
+            raise CommandError('Run history_denormalize first.')
+        consumer_type = None
+        if options['model']:
+            try:
+                model = db_models.get_model(*options['model'].split('.'))
+            except TypeError:
+                model = None
+            if model is None:
+                raise CommandError('Unknown model: %s' % options['model'])
+            consumer_type = ContentType.objects.get_for_model(model)
+        elif options['consumer_id'] is not None:
+            raise CommandError('--consumer-id requires --model')
+
+        try:
+            dates = [
+                options[key] and export.parse_date(options[key])
+                for key in ('date_from', 'date_to')]
+        except ValueError:
+            raise CommandError('Dates must be in YYYY-MM-DD format')
+
+        chunks = export.export(
+            format=options['format'], with_text=options['with_text'],
+            **export.get_filters(
+                consumer_type, options['consumer_id'], *dates))
+        output = open(options['output'], 'wb') if options['output'] else (
+            self.stdout)
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
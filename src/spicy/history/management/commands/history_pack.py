@@ -0,0 +1,46 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from spicy.history import models, utils
+
+
+class Command(BaseCommand):
+    help = 'Convert stored diffs to the packed encoding in batches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of diffs converted in one transaction.'),
+        make_option(
+            '--sleep', dest='sleep', type='float', default=0,
+            help='Seconds to wait between batches.'),
+        make_option(
+            '--keep-text', dest='keep_text', action='store_true',
+            default=False, help="Don't clear unified diff text."),
+    )
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        converted = 0
+        while True:
+            diffs = list(models.Diff.objects.filter(
+                pk__gt=last_pk, packed_change__isnull=True
+                ).order_by('pk').values_list('pk', 'change')[
+                    :options['batch_size']])
+            if not diffs:
+                break
+
+            with transaction.commit_on_success():
+                for pk, change in diffs:
+                    update = dict(packed_change=utils.pack_patch(
+                        utils.compile_patch(change)))
+                    if not options['keep_text']:
+                        update['change'] = ''
+                    models.Diff.objects.filter(pk=pk).update(**update)
+
+            last_pk = diffs[-1][0]
+            converted += len(diffs)
+            self.stdout.write('Converted %d diffs\n' % converted)
+            if options['sleep']:
+                time.sleep(options['sleep'])
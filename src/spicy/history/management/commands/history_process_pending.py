@@ -0,0 +1,53 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from spicy.history import listeners, models
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute diffs for changes recorded by asynchronous history capture. '
+        'Several workers can run in parallel, each handling its own share of '
+        'objects so that versions of every object are assigned in order.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of changes fetched at once.'),
+        make_option(
+            '--loop', dest='loop', action='store_true', default=False,
+            help='Keep waiting for new changes instead of exiting.'),
+        make_option(
+            '--sleep', dest='sleep', type='float', default=5,
+            help='Seconds to wait when the queue is empty in loop mode.'),
+        make_option(
+            '--workers', dest='workers', type='int', default=1,
+            help='Total number of workers.'),
+        make_option(
+            '--worker', dest='worker', type='int', default=0,
+            help='Number of this worker, from 0 to workers - 1.'),
+    )
+
+    def handle(self, *args, **options):
+        workers, worker = options['workers'], options['worker']
+        if not 0 <= worker < workers:
+            raise CommandError('Worker number must be less than workers.')
+
+        pending = models.PendingChange.objects.select_related(
+            'action').order_by('pk')
+        if workers > 1:
+            pending = pending.extra(
+                where=['hs_action.consumer_id %% %s = %s'],
+                params=[workers, worker])
+
+        processed = 0
+        while True:
+            count = listeners.process_pending(
+                pending[:options['batch_size']])
+            processed += count
+            if count:
+                self.stdout.write('Processed %d changes\n' % processed)
+            elif options['loop']:
+                time.sleep(options['sleep'])
+            else:
+                break
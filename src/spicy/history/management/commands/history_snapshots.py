@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.contenttypes.models import ContentType
+from spicy.history import defaults, models, utils
+
+
+class Command(BaseCommand):
+    args = '[app_label.Model ...]'
+    help = (
+        'Create missing snapshots for existing history, '
+        'optionally limited to the given models.')
+
+    def handle(self, *labels, **options):
+        if not models.Diff.objects.is_denormalized():
+            raise CommandError('Run history_denormalize first.')
+        diffs = models.Diff.objects.all()
+        if labels:
+            ctypes = []
+            for label in labels:
+                try:
+                    app_label, model = label.split('.')
+                    ctypes.append(ContentType.objects.get(
+                        app_label=app_label, model=model.lower()))
+                except (ValueError, ContentType.DoesNotExist):
+                    raise CommandError('Unknown model: %s' % label)
+            diffs = diffs.filter(consumer_type__in=ctypes)
+
+        keys = diffs.values_list(
+            'consumer_type', 'consumer_id', 'field'
+            ).order_by().distinct()
+
+        created = 0
+        for consumer_type_id, consumer_id, field in keys.iterator():
+            created += self.backfill(consumer_type_id, consumer_id, field)
+        self.stdout.write('Created %d snapshots\n' % created)
+
+    def backfill(self, consumer_type_id, consumer_id, field):
+        snapshots = set(models.Snapshot.objects.filter(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field).values_list('version', flat=True))
+        changes = models.Diff.objects.filter(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field
+            ).order_by('version').values_list(
+                'version', 'change', 'packed_change')
+
+        created = 0
+        lines = None
+        base_version = size = 0
+        for version, change, packed_change in changes.iterator():
+            if lines is None:
+                lines = []
+                if version > 1:
+                    # Versions below the first one left may be archived,
+                    # leaving a snapshot of the last of them.
+                    base_version = version - 1
+                    lines = utils.split_text(models.Diff(
+                        consumer_type_id=consumer_type_id,
+                        consumer_id=consumer_id, field=field,
+                        version=base_version).get_version_text())
+            lines = utils.apply_patch(lines, utils.get_patch_ops(
+                change, packed_change, defaults.HISTORY_STRICT_PATCHES))
+            size += len(packed_change or change)
+            if version in snapshots:
+                base_version, size = version, 0
+            # A single empty line can't be told apart from empty text once
+            # joined, so such versions are never snapshotted.
+            elif (models.Snapshot.is_due(version - base_version, size) and
+                    lines != [u'']):
+                models.Snapshot.objects.create(
+                    consumer_type_id=consumer_type_id,
+                    consumer_id=consumer_id, field=field, version=version,
+                    text=u'\n'.join(lines))
+                base_version, size = version, 0
+                created += 1
+        return created
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models as db_models, transaction
+from spicy.history import defaults, timeline
+
+
+class Command(BaseCommand):
+    args = '[app_label.Model ...]'
+    help = (
+        'Rebuild timeline entries of timeline observed models, optionally '
+        'limited to the given ones.')
+
+    def handle(self, *labels, **options):
+        for label in labels or defaults.TIMELINE_FIELDS:
+            try:
+                model = db_models.get_model(*label.split('.'))
+            except TypeError:
+                model = None
+            if model is None:
+                raise CommandError('Unknown model: %s' % label)
+
+            count = 0
+            for instance in model._default_manager.all().iterator():
+                with transaction.commit_on_success():
+                    timeline.update(instance)
+                count += 1
+            self.stdout.write('%s: %d objects\n' % (label, count))
@@ -1,9 +1,102 @@
-from django.db import models
+import itertools
+import operator
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max, Min, Q
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.utils.translation import ugettext_lazy as _
+from functools import reduce
 from spicy.core.service import models as service_models
 from spicy.core.profile.defaults import CUSTOM_USER_MODEL
 from spicy.utils import cached_property
-from . import defaults, utils, listeners
+from . import archive, caching, defaults, registry, utils
+
+
+CONSUMERS_CHUNK_SIZE = 500
+
+
+class ActionQuerySet(QuerySet):
+    consumer_fields = None
+    prefetches_consumers = False
+
+    def prefetch_consumers(self, only=None):
+        """
+        Load consumers of actions with one query per consumer type for every
+        chunk of results, and their profiles and rollback diffs along with
+        actions. ``only`` restricts loaded consumer fields.
+        """
+        return self.select_related('profile', 'rollback_to')._clone(
+            prefetches_consumers=True, consumer_fields=only)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('prefetches_consumers', self.prefetches_consumers)
+        kwargs.setdefault('consumer_fields', self.consumer_fields)
+        return super(ActionQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        actions = super(ActionQuerySet, self).iterator()
+        if not self.prefetches_consumers:
+            for action in actions:
+                yield action
+            return
+
+        while True:
+            chunk = list(itertools.islice(actions, CONSUMERS_CHUNK_SIZE))
+            if not chunk:
+                break
+            self.model.objects.attach_consumers(
+                chunk, only=self.consumer_fields)
+            for action in chunk:
+                yield action
+
+
+class ActionManager(models.Manager):
+    def get_query_set(self):
+        return ActionQuerySet(self.model, using=self._db)
+
+    def prefetch_consumers(self, only=None):
+        return self.get_query_set().prefetch_consumers(only=only)
+
+    def attach_consumers(self, actions, only=None, manager=None):
+        """
+        Set consumers of fetched ``actions``, loading them with one query per
+        consumer type. Consumers are taken from the ``manager`` of their model
+        if it has one. Deleted consumers are set to None.
+        """
+        consumer_ids = defaultdict(set)
+        for action in actions:
+            consumer_ids[action.consumer_type_id].add(action.consumer_id)
+        consumers = {}
+        for consumer_type_id, ids in consumer_ids.iteritems():
+            model = ContentType.objects.get_for_id(
+                consumer_type_id).model_class()
+            if model is None:
+                continue
+            queryset = getattr(
+                model, manager or '_default_manager',
+                model._default_manager).all()
+            if only:
+                queryset = queryset.only(*only)
+            consumers.update(
+                ((consumer_type_id, pk), consumer)
+                for pk, consumer in queryset.in_bulk(list(ids)).iteritems())
+
+        cache_attr = getattr(self.model.consumer, 'cache_attr', 'consumer')
+        for action in actions:
+            setattr(action, cache_attr, consumers.get(
+                (action.consumer_type_id, action.consumer_id)))
+
+    def prefetch(self, actions, only=None):
+        """
+        Return a list of fetched ``actions`` with their consumers, profiles,
+        rollback diffs and diffs loaded with a fixed number of queries.
+        """
+        actions = list(actions)
+        prefetch_related_objects(
+            actions, ['profile', 'rollback_to', 'diff_set'])
+        self.attach_consumers(actions, only=only)
+        return actions
 
 
 class Action(service_models.ProviderModel):
@@ -20,11 +113,30 @@ class Action(service_models.ProviderModel):
     # show_in_timeline doesn't guarantee that this action goes to timeline,
     # so it'll be set to False only if we know that this action happened today.
 
+    objects = ActionManager()
+
     def is_rollback(self):
         return self.action_type == defaults.ACTION_ROLLBACK
 
+    def make_diff(self, field, version, patch):
+        """
+        Return a new unsaved diff of the ``field`` made by this action.
+        """
+        diff = Diff(
+            action=self, consumer_type_id=self.consumer_type_id,
+            consumer_id=self.consumer_id, field=field, version=version)
+        diff.set_change(patch)
+        return diff
+
+    def is_pending(self):
+        """
+        Check if diffs of this action are yet to be computed.
+        """
+        return PendingChange.objects.filter(action=self).exists()
+
     def consumer_model_verbose(self):
-        return self.consumer_type.model_class()._meta.verbose_name
+        return ContentType.objects.get_for_id(
+            self.consumer_type_id).model_class()._meta.verbose_name
 
     @models.permalink
     def get_absolute_url(self):
@@ -38,72 +150,475 @@ class Action(service_models.ProviderModel):
     class Meta:
         ordering = ['-date_joined']
         db_table = 'hs_action'
+        index_together = (
+            ('consumer_type', 'consumer_id', 'date_joined'),
+            ('show_in_timeline', 'action_type', 'date_joined'),
+        )
         permissions = (
             ('rollback', 'Rollback history'),
             ('view_history', 'View history'),
         )
 
 
+class DiffManager(models.Manager):
+    # Set once no diff is left for the history_denormalize command.
+    _is_denormalized = False
+
+    def is_denormalized(self):
+        """
+        Return True if consumer type and id are set on all diffs.
+        """
+        if not DiffManager._is_denormalized:
+            DiffManager._is_denormalized = not self.filter(
+                consumer_type__isnull=True).exists()
+        return DiffManager._is_denormalized
+
+    def denormalize(self, consumer_type_id, consumer_id):
+        """
+        Copy consumer type and id from actions to diffs of the consumer which
+        the history_denormalize command hasn't reached yet, so lookups by
+        these columns find all of them.
+        """
+        if self.is_denormalized():
+            return
+        self.filter(
+            consumer_type__isnull=True,
+            action__consumer_type__id=consumer_type_id,
+            action__consumer_id=consumer_id).update(
+                consumer_type=consumer_type_id, consumer_id=consumer_id)
+
+    def fill_consumers(self, diffs):
+        """
+        Set consumer type and id of ``diffs`` which weren't denormalized yet
+        from their actions, along with other diffs of their consumers.
+        """
+        for diff in diffs:
+            if diff.consumer_type_id is None:
+                diff.consumer_type_id, diff.consumer_id = (
+                    diff.action.consumer_type_id, diff.action.consumer_id)
+                self.denormalize(diff.consumer_type_id, diff.consumer_id)
+        return diffs
+
+    def prefetch_neighbours(self, diffs, window=0):
+        """
+        Load first, previous, next and last versions of ``diffs`` with a
+        single query, along with ``window`` versions around each of them,
+        which are put to the ``versions`` attribute.
+        """
+        diffs = list(diffs)
+        if not diffs:
+            return diffs
+
+        self.fill_consumers(diffs)
+
+        radius = max(window, 1)
+        keys = set(diff.field_key for diff in diffs)
+        last_versions = dict(
+            ((head.consumer_type_id, head.consumer_id, head.field),
+             head.version)
+            for head in Head.objects.filter(reduce(operator.or_, (
+                Q(consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+                  field=field)
+                for consumer_type_id, consumer_id, field in keys))))
+        for key in keys - set(last_versions):
+            last_versions[key] = Head.objects.get_for(*key).version
+
+        queries = []
+        for diff in diffs:
+            consumer_type_id, consumer_id, field = diff.field_key
+            queries.append(
+                Q(consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+                  field=field) &
+                (Q(version__in=(1, last_versions[diff.field_key])) |
+                 Q(version__range=(
+                     diff.version - radius, diff.version + radius))))
+        neighbours = defaultdict(dict)
+        for neighbour in self.select_related('action').filter(
+                reduce(operator.or_, queries)):
+            neighbours[neighbour.field_key][neighbour.version] = neighbour
+
+        for diff in diffs:
+            diff._neighbours = neighbours[diff.field_key]
+            diff._last_version = last_versions[diff.field_key]
+            diff.versions = [
+                diff._neighbours[version]
+                for version in sorted(diff._neighbours)
+                if abs(version - diff.version) <= window]
+        return diffs
+
+    def with_neighbours(self, pk, window=0):
+        """
+        Return diff with its neighbours loaded, see ``prefetch_neighbours``.
+        """
+        diff = self.get_with_archived(pk)
+        if diff.is_archived:
+            return diff
+        return self.prefetch_neighbours([diff], window)[0]
+
+    def has_archived(self, consumer_type_id, consumer_id, field):
+        """
+        Return True if versions of the field may have been moved to the
+        archive. The history_archive command leaves a snapshot of the last
+        archived version below the versions left in the database, while
+        other snapshots are made of versions which are kept in it.
+        """
+        if not archive.is_enabled():
+            return False
+        key = dict(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field)
+        first_version = self.filter(**key).aggregate(
+            version=Min('version'))['version']
+        return first_version is None or Snapshot.objects.filter(
+            version__lt=first_version, **key).exists()
+
+    def _get_base(self, consumer_type_id, consumer_id, field, version):
+        """
+        Return text and version of the nearest snapshot at or below
+        ``version``, or an empty text before the first version, along with
+        archived diffs following it. Snapshots below the versions left in
+        the database are archived with them.
+        """
+        self.denormalize(consumer_type_id, consumer_id)
+        try:
+            snapshot = Snapshot.objects.filter(
+                consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+                field=field, version__lte=version).order_by('-version')[0]
+        except IndexError:
+            pass
+        else:
+            return snapshot.text, snapshot.version, []
+        if not self.has_archived(consumer_type_id, consumer_id, field):
+            return u'', 0, []
+
+        diffs, snapshots = archive.get_history(
+            consumer_type_id, consumer_id, field)
+        base_version = max([
+            snapshot_version for snapshot_version in snapshots
+            if snapshot_version <= version] or [0])
+        return snapshots.get(base_version, u''), base_version, [
+            diff for diff in diffs if diff.version > base_version]
+
+    def _get_changes(
+            self, archived, consumer_type_id, consumer_id, field,
+            base_version, version):
+        """
+        Return an iterator over ``(version, change, packed_change)`` of
+        versions of the field after ``base_version`` up to ``version``,
+        starting with ``archived`` diffs.
+        """
+        if archived:
+            # Rows of an interrupted archiving may be left in the database.
+            base_version = max(base_version, archived[-1].version)
+        return itertools.chain(
+            ((diff.version, diff.change, diff.packed_change)
+             for diff in archived if diff.version <= version),
+            self.filter(
+                consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+                field=field, version__gt=base_version,
+                version__lte=version).order_by('version').values_list(
+                    'version', 'change', 'packed_change').iterator())
+
+    def get_with_archived(self, pk):
+        """
+        Return diff by id, reading it from the archive if it was moved there.
+        """
+        try:
+            return self.fill_consumers(
+                [self.select_related('action').get(pk=pk)])[0]
+        except self.model.DoesNotExist:
+            if archive.is_enabled():
+                diff = archive.get_diff(int(pk))
+                if diff is not None:
+                    return diff
+            raise
+
+    def get_version_at(self, consumer_type_id, consumer_id, field, when):
+        """
+        Return the last version of the field made at or before ``when``.
+        """
+        self.denormalize(consumer_type_id, consumer_id)
+        version = self.filter(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field, action__date_joined__lte=when).aggregate(
+                version=Max('version'))['version']
+        if version is None and self.has_archived(
+                consumer_type_id, consumer_id, field):
+            diffs = archive.get_history(
+                consumer_type_id, consumer_id, field)[0]
+            made = set(Action.objects.filter(
+                pk__in=set(diff.action_id for diff in diffs),
+                date_joined__lte=when).values_list('pk', flat=True))
+            version = max(
+                [diff.version for diff in diffs if diff.action_id in made] or
+                [0])
+        return version or 0
+
+    def compare(
+            self, consumer_type_id, consumer_id, field, from_version,
+            to_version):
+        """
+        Return unified diff between two versions of the field. Patches
+        between them are composed on the text of the older version, so no
+        other version is rebuilt and no texts are diffed. The result is
+        cached.
+        """
+        from_version, to_version = sorted((from_version, to_version))
+        key = caching.get_compare_key(
+            consumer_type_id, consumer_id, field, from_version, to_version)
+        patch = caching.cache.get(key)
+        if patch is not None:
+            return patch
+
+        base, base_version, archived = self._get_base(
+            consumer_type_id, consumer_id, field, from_version)
+        old = new = utils.split_text(base)
+        origins = range(len(old))
+        for version, change, packed_change in self._get_changes(
+                archived, consumer_type_id, consumer_id, field, base_version,
+                to_version):
+            ops = utils.get_patch_ops(
+                change, packed_change, defaults.HISTORY_STRICT_PATCHES)
+            new = utils.apply_patch(new, ops)
+            # Squashed versions leave gaps, so ``from_version`` itself may be
+            # missing and the last version below it is the same text.
+            if version <= from_version:
+                old = new
+                origins = range(len(old))
+            else:
+                origins = utils.apply_blame(origins, ops, None)
+
+        patch = utils.render_patch(utils.make_net_patch(old, new, origins))
+        caching.cache.set(key, patch, defaults.HISTORY_COMPARE_CACHE_TIMEOUT)
+        return patch
+
+    def iter_versions(
+            self, consumer_type_id, consumer_id, field, start=1, end=None):
+        """
+        Yield ``(version, action, text)`` for versions of the field from
+        ``start`` to ``end`` (the last one by default), applying each patch
+        once on top of the nearest snapshot below ``start``. Patches are
+        fetched with a single streamed query.
+        """
+        base, base_version, archived = self._get_base(
+            consumer_type_id, consumer_id, field, start - 1)
+        if archived:
+            base_version = archived[-1].version
+        diffs = self.select_related('action').filter(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field, version__gt=base_version).order_by('version')
+        if end is not None:
+            diffs = diffs.filter(version__lte=end)
+            archived = [diff for diff in archived if diff.version <= end]
+        actions = Action.objects.in_bulk(
+            set(diff.action_id for diff in archived))
+        for diff in archived:
+            diff.action = actions.get(diff.action_id)
+
+        lines = utils.split_text(base)
+        for diff in itertools.chain(archived, diffs.iterator()):
+            lines = utils.apply_patch(lines, utils.get_patch_ops(
+                diff.change, diff.packed_change,
+                defaults.HISTORY_STRICT_PATCHES))
+            if diff.version >= start:
+                yield diff.version, diff.action, u'\n'.join(lines)
+
+    def blame(self, consumer_type_id, consumer_id, field, version):
+        """
+        Return a list of ``(line, diff)`` pairs of the field text at
+        ``version``, where ``diff`` is the last one which changed the line.
+        Patches are applied once from the first version, tracking versions
+        which inserted every line, and the result is cached.
+        """
+        key = caching.get_blame_key(
+            consumer_type_id, consumer_id, field, version)
+        blame = caching.cache.get(key)
+        if blame is None:
+            lines, origins = [], []
+            archived = self._get_base(
+                consumer_type_id, consumer_id, field, 0)[2]
+            for diff_version, change, packed_change in self._get_changes(
+                    archived, consumer_type_id, consumer_id, field, 0,
+                    version):
+                ops = utils.get_patch_ops(
+                    change, packed_change, defaults.HISTORY_STRICT_PATCHES)
+                lines = utils.apply_patch(lines, ops)
+                origins = utils.apply_blame(origins, ops, diff_version)
+            blame = zip(lines, origins)
+            caching.cache.set(
+                key, blame, defaults.HISTORY_BLAME_CACHE_TIMEOUT)
+
+        diffs = dict(
+            (diff.version, diff) for diff in self.select_related(
+                'action__profile').filter(
+                    consumer_type__id=consumer_type_id,
+                    consumer_id=consumer_id, field=field,
+                    version__in=set(origin for line, origin in blame)))
+        if len(diffs) < len(set(origin for line, origin in blame)) and (
+                self.has_archived(consumer_type_id, consumer_id, field)):
+            for diff in archive.get_history(
+                    consumer_type_id, consumer_id, field)[0]:
+                diffs.setdefault(diff.version, diff)
+        return [(line, diffs.get(origin)) for line, origin in blame]
+
+
 class Diff(models.Model):
     action = models.ForeignKey(Action)
+    # Copied from the action, so navigating versions doesn't need a join.
+    consumer_type = models.ForeignKey(ContentType, null=True)
+    consumer_id = models.PositiveIntegerField(null=True)
     version = models.PositiveIntegerField()
     change = models.TextField()
+    # Compact encoding of the change, see utils.pack_patch. Takes precedence
+    # over the text of unified diff, which is left empty for packed diffs.
+    packed_change = models.TextField(null=True, blank=True)
     field = models.CharField(
         max_length=255,
         choices=[(field, field) for field in defaults.OBSERVED_FIELD_NAMES])
 
+    def set_change(self, patch):
+        """
+        Store unified diff ``patch``, packing it if HISTORY_PACKED_PATCHES
+        is set.
+        """
+        if defaults.HISTORY_PACKED_PATCHES:
+            self.change = ''
+            self.packed_change = utils.pack_patch(utils.compile_patch(patch))
+        else:
+            self.change = patch
+            self.packed_change = None
+
+    def get_change(self):
+        """
+        Return the change as unified diff. Packed changes have no context.
+        """
+        if self.packed_change:
+            return utils.render_patch(utils.unpack_patch(self.packed_change))
+        return self.change
+
+    def get_patch_size(self):
+        return len(self.packed_change or self.change)
+
+    objects = DiffManager()
+
+    # Versions loaded by DiffManager.prefetch_neighbours.
+    _neighbours = None
+    _last_version = None
+
+    # Set for diffs read from the archive, see ``archive`` module.
+    is_archived = False
+
+    @property
+    def field_key(self):
+        return self.consumer_type_id, self.consumer_id, self.field
+
+    @cached_property
+    def archived_versions(self):
+        """
+        Archived diffs of the field, which precede ones in the database.
+        """
+        if not self.is_archived and not Diff.objects.has_archived(
+                *self.field_key):
+            return []
+        return archive.get_history(*self.field_key)[0]
+
+    # Versions squashed by the history_compact command leave gaps, so
+    # neighbours missing from prefetched ones are looked up by order.
+
     @cached_property
     def first_version(self):
+        if self._neighbours is not None and 1 in self._neighbours:
+            return self._neighbours[1]
+        if self.archived_versions:
+            return self.archived_versions[0]
         try:
-            return Diff.objects.select_related('action').order_by(
-                'version').get(
-                    action__consumer_type__id=self.action.consumer_type_id,
-                    action__consumer_id=self.action.consumer_id,
-                    field=self.field, version=1)
-        except Diff.DoesNotExist:
+            return Diff.objects.select_related('action').filter(
+                consumer_type__id=self.consumer_type_id,
+                consumer_id=self.consumer_id,
+                field=self.field).order_by('version')[0]
+        except IndexError:
             pass
-        
+
     @cached_property
     def prev_version(self):
+        if self._neighbours is not None and (
+                self.version - 1 in self._neighbours or self.version == 1):
+            return self._neighbours.get(self.version - 1)
         try:
-            return Diff.objects.select_related('action').get(
-                action__consumer_type__id=self.action.consumer_type_id,
-                action__consumer_id=self.action.consumer_id,
-                field=self.field, version=self.version-1)
-        except Diff.DoesNotExist:
+            return Diff.objects.select_related('action').filter(
+                consumer_type__id=self.consumer_type_id,
+                consumer_id=self.consumer_id, field=self.field,
+                version__lt=self.version).order_by('-version')[0]
+        except IndexError:
             pass
-        
+        for diff in reversed(self.archived_versions):
+            if diff.version < self.version:
+                return diff
+
     @cached_property
     def next_version(self):
+        if self._neighbours is not None and (
+                self.version + 1 in self._neighbours or
+                self.version == self._last_version):
+            return self._neighbours.get(self.version + 1)
+        # Versions left in the database follow archived ones.
+        if self.is_archived:
+            for diff in self.archived_versions:
+                if diff.version > self.version:
+                    return diff
         try:
-            return Diff.objects.select_related('action').get(
-                action__consumer_type__id=self.action.consumer_type_id,
-                action__consumer_id=self.action.consumer_id,
-                field=self.field, version=self.version+1)
-        except Diff.DoesNotExist:
+            return Diff.objects.select_related('action').filter(
+                consumer_type__id=self.consumer_type_id,
+                consumer_id=self.consumer_id, field=self.field,
+                version__gt=self.version).order_by('version')[0]
+        except IndexError:
             pass
 
     @cached_property
     def last_version(self):
+        if self._neighbours is not None:
+            return self._neighbours.get(self._last_version)
+        try:
+            return Head.objects.select_related('diff__action').get(
+                consumer_type__id=self.consumer_type_id,
+                consumer_id=self.consumer_id, field=self.field).diff
+        except Head.DoesNotExist:
+            pass
         try:
             return Diff.objects.select_related('action').filter(
-                action__consumer_type__id=self.action.consumer_type_id,
-                action__consumer_id=self.action.consumer_id,
+                consumer_type__id=self.consumer_type_id,
+                consumer_id=self.consumer_id,
                 field=self.field).order_by('-version')[0]
         except IndexError:
             pass
+        if self.archived_versions:
+            return self.archived_versions[-1]
+
+    def reconstruct(self):
+        """
+        Return a tuple of version text, version of the snapshot it was built
+        from and size of the patches replayed on top of that snapshot.
+        """
+        base, base_version, archived = Diff.objects._get_base(
+            self.consumer_type_id, self.consumer_id, self.field, self.version)
+        changes = Diff.objects._get_changes(
+            archived, self.consumer_type_id, self.consumer_id, self.field,
+            base_version, self.version)
+        lines = utils.split_text(base)
+        size = 0
+        for version, change, packed_change in changes:
+            lines = utils.apply_patch(lines, utils.get_patch_ops(
+                change, packed_change, defaults.HISTORY_STRICT_PATCHES))
+            size += len(packed_change or change)
+        return u'\n'.join(lines), base_version, size
 
     def get_version_text(self):
-        return utils.merge([
-            value[0] for value in self.__class__.objects.filter(
-                action__consumer_type__id=self.action.consumer_type_id,
-                action__consumer_id=self.action.consumer_id, field=self.field,
-                version__lte=self.version
-                ).order_by('version').values_list('change', 'version')])
+        return self.reconstruct()[0]
 
     def verbose_field_name(self):
         if self.field:
-            model = self.action.consumer_type.model_class()
+            model = ContentType.objects.get_for_id(
+                self.consumer_type_id).model_class()
             name = getattr(
                 getattr(
                     getattr(model, self.field, None), 'fget', None),
@@ -127,6 +642,191 @@ class Diff(models.Model):
         unique_together = (
             ('action', 'field'),
         )
+        index_together = (
+            ('consumer_type', 'consumer_id', 'field', 'version'),
+        )
+
+
+class TimelineEntry(models.Model):
+    """
+    Action shown in a public timeline, see ``timeline`` module.
+    """
+    action = models.ForeignKey(Action)
+    consumer_type = models.ForeignKey(ContentType)
+    consumer_id = models.PositiveIntegerField()
+    key = models.CharField(max_length=255)
+    is_public = models.BooleanField(default=True)
+    date_joined = models.DateTimeField()
+
+    class Meta:
+        db_table = 'hs_timeline_entry'
+        ordering = ['-date_joined', '-id']
+        index_together = (
+            ('key', 'is_public', 'consumer_type', 'date_joined'),
+            ('consumer_type', 'consumer_id'),
+        )
+
+
+class PendingChange(models.Model):
+    """
+    New values of observed fields waiting for their diffs to be computed.
+    """
+    action = models.OneToOneField(Action)
+    consumer_name = models.TextField()
+    values = models.TextField()
+
+    class Meta:
+        db_table = 'hs_pending_change'
+
+
+class HeadManager(models.Manager):
+    def get_for(
+            self, consumer_type_id, consumer_id, field, for_update=False):
+        """
+        Return head of the field, building it from the stored history if it
+        doesn't exist yet. With ``for_update`` the head row stays locked
+        until the end of the transaction, so concurrent saves get
+        consecutive versions.
+        """
+        heads = self.select_for_update() if for_update else self.all()
+        heads = heads.filter(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field)
+        try:
+            return heads.get()
+        except self.model.DoesNotExist:
+            pass
+
+        Diff.objects.denormalize(consumer_type_id, consumer_id)
+        head = self.model(
+            consumer_type_id=consumer_type_id, consumer_id=consumer_id,
+            field=field)
+        diffs = Diff.objects.select_related('action').filter(
+            consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+            field=field).order_by('-version')
+        try:
+            last_version = diffs[0].version
+        except IndexError:
+            pass
+        else:
+            # Saves made before heads existed could write the same version
+            # twice.
+            diffs = list(diffs.filter(version=last_version))
+            for diff in diffs[1:]:
+                diff.delete()
+            head.diff = diffs[0]
+            head.text, head.snapshot_version, head.patch_size = (
+                head.diff.reconstruct())
+            head.version = last_version
+            head.date = head.diff.action.date_joined
+
+        sid = transaction.savepoint()
+        try:
+            head.save()
+        except IntegrityError:
+            # Built by a concurrent save.
+            transaction.savepoint_rollback(sid)
+            return heads.get()
+        transaction.savepoint_commit(sid)
+        return head
+
+
+class Head(models.Model):
+    """
+    Latest text, version, diff and its date of an observed field, so saving
+    an object doesn't require reconstructing or scanning its history.
+    """
+    consumer_type = models.ForeignKey(ContentType)
+    consumer_id = models.PositiveIntegerField()
+    field = models.CharField(max_length=255)
+    version = models.PositiveIntegerField(default=0)
+    text = models.TextField(blank=True, default=u'')
+    snapshot_version = models.PositiveIntegerField(default=0)
+    patch_size = models.PositiveIntegerField(default=0)
+    diff = models.ForeignKey('Diff', null=True, related_name='+')
+    date = models.DateTimeField(null=True)
+
+    objects = HeadManager()
+
+    def advance(self, diff, text, commit=True):
+        """
+        Move head to a newly created ``diff`` which results in ``text``,
+        taking a snapshot if it's due. Return the snapshot if any; nothing
+        is saved unless ``commit`` is set.
+        """
+        self.version = diff.version
+        self.diff = diff
+        self.text = text
+        self.date = diff.action.date_joined
+        self.patch_size += diff.get_patch_size()
+        snapshot = None
+        if Snapshot.is_due(
+                self.version - self.snapshot_version, self.patch_size):
+            snapshot = Snapshot(
+                consumer_type_id=self.consumer_type_id,
+                consumer_id=self.consumer_id, field=self.field,
+                version=self.version, text=text)
+            self.snapshot_version = self.version
+            self.patch_size = 0
+
+        if commit:
+            if snapshot is not None:
+                snapshot.save()
+            self.save()
+            self.verify()
+        return snapshot
+
+    def verify(self):
+        """
+        Replay history up to the head version and make sure it matches the
+        head text, if HISTORY_VERIFY_PATCHES is set.
+        """
+        if defaults.HISTORY_VERIFY_PATCHES and self.diff_id:
+            assert self.diff.get_version_text() == self.text,\
+                "Patch replay doesn't match head text: %s" % self.diff
+
+    def __unicode__(self):
+        return u'{field}@{version}'.format(
+            field=self.field, version=self.version)
+
+    class Meta:
+        db_table = 'hs_head'
+        unique_together = (
+            ('consumer_type', 'consumer_id', 'field'),
+        )
+
+
+class Snapshot(models.Model):
+    """
+    Full text of a field at some version, used as a starting point for
+    reconstruction instead of the first version.
+    """
+    consumer_type = models.ForeignKey(ContentType)
+    consumer_id = models.PositiveIntegerField()
+    field = models.CharField(max_length=255)
+    version = models.PositiveIntegerField()
+    text = models.TextField()
+
+    @staticmethod
+    def is_due(versions, size):
+        """
+        Check if a snapshot should be taken after replaying ``versions``
+        patches of total ``size`` since the previous one.
+        """
+        return bool(
+            (defaults.HISTORY_SNAPSHOT_INTERVAL and
+             versions >= defaults.HISTORY_SNAPSHOT_INTERVAL) or
+            (defaults.HISTORY_SNAPSHOT_PATCH_SIZE and
+             size >= defaults.HISTORY_SNAPSHOT_PATCH_SIZE))
+
+    def __unicode__(self):
+        return u'{field}@{version}'.format(
+            field=self.field, version=self.version)
+
+    class Meta:
+        db_table = 'hs_snapshot'
+        unique_together = (
+            ('consumer_type', 'consumer_id', 'field', 'version'),
+        )
 
-models.signals.post_save.connect(listeners.object_post_save)
-models.signals.pre_delete.connect(listeners.object_pre_delete)
+registry.setup()
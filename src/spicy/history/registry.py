@@ -0,0 +1,120 @@
+"""
+Registry of observed models.
+
+History listeners are connected only to model classes named in
+OBSERVED_FIELDS or TIMELINE_FIELDS, so saving and deleting other objects
+costs nothing. Settings of every observed class are computed once, when the
+class is loaded, instead of on every save.
+"""
+import datetime
+from django.db.models import signals
+from django.db.models.loading import get_model
+from . import defaults, utils
+
+
+_observations = {}
+
+
+class Observation(object):
+    """
+    Precomputed observation settings of a model.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.has_fields = label in defaults.OBSERVED_FIELDS
+        self.fields = frozenset(defaults.OBSERVED_FIELDS.get(label, ()))
+        self.timeline_fields = frozenset(
+            defaults.TIMELINE_FIELDS.get(label, ()))
+        self.timeline_actions = utils.get_observed_actions(label)
+        self.is_timeline = utils.is_timeline_model(label)
+        self.tracked_fields = self.fields | self.timeline_fields
+        window = defaults.HISTORY_COALESCE_WINDOWS.get(label)
+        self.coalesce_window = window and datetime.timedelta(minutes=window)
+
+    def is_observed(self, action_type):
+        return self.has_fields or action_type in self.timeline_actions
+
+    def get_fields(self, action_type):
+        """
+        Return fields whose diffs are recorded for ``action_type``.
+        """
+        if action_type in self.timeline_actions:
+            return self.fields | self.timeline_fields
+        return self.fields
+
+
+def get_label(model):
+    if model._deferred:
+        # Classes of objects loaded with only() or defer().
+        model = model._meta.proxy_for_model
+    return '.'.join((model._meta.app_label, model._meta.object_name))
+
+
+def get_labels():
+    return set(defaults.OBSERVED_FIELDS) | set(defaults.TIMELINE_FIELDS)
+
+
+def get(model):
+    """
+    Return observation of a model class, or None if it isn't observed.
+    """
+    return _observations.get(model)
+
+
+def connect(model):
+    from . import listeners
+    _observations[model] = Observation(get_label(model))
+    uid = 'spicy.history.%s' % get_label(model)
+    signals.post_save.connect(
+        listeners.object_post_save, sender=model, dispatch_uid=uid)
+    signals.pre_delete.connect(
+        listeners.object_pre_delete, sender=model, dispatch_uid=uid)
+    if defaults.HISTORY_TRACK_CHANGES:
+        signals.post_init.connect(
+            listeners.object_post_init, sender=model, dispatch_uid=uid)
+
+
+def class_prepared(sender, **kwargs):
+    if get_label(sender) in get_labels():
+        connect(sender)
+
+
+def setup():
+    """
+    Connect listeners to observed models loaded so far and to the ones which
+    are loaded later.
+    """
+    signals.class_prepared.connect(
+        class_prepared, dispatch_uid='spicy.history.registry')
+    for label in get_labels():
+        model = get_model(
+            *label.split('.'), seed_cache=False, only_installed=False)
+        if model is not None:
+            connect(model)
+
+
+def register(
+        model, fields=(), timeline_fields=(), coalesce_window=None,
+        **actions):
+    """
+    Observe ``model`` (a class or app_label.Model label) at runtime: record
+    diffs of ``fields``, and of ``timeline_fields`` for timeline actions
+    given as ``create=True`` etc. (see ``utils.observe``). Edits are
+    coalesced within ``coalesce_window`` minutes if it's given.
+    """
+    if isinstance(model, basestring):
+        label = model
+        model = get_model(
+            *label.split('.'), seed_cache=False, only_installed=False)
+    else:
+        label = get_label(model)
+
+    if fields:
+        defaults.OBSERVED_FIELDS[label] = tuple(fields)
+    if actions:
+        utils.observe(label, **actions)
+        defaults.TIMELINE_FIELDS[label] = tuple(timeline_fields)
+    if coalesce_window is not None:
+        defaults.HISTORY_COALESCE_WINDOWS[label] = coalesce_window
+    if model is not None:
+        connect(model)
@@ -1,10 +1,11 @@
-import difflib
+import copy
+import datetime
 import operator
-from collections import defaultdict
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, InvalidPage
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q, Count
+from django.db import transaction
+from django.db.models import Q, Count, Max
 from django.db.models.fields import related
 from django.http import Http404
 from django.template import Context
@@ -14,9 +15,38 @@ from functools import reduce
 from spicy.core.admin import defaults as admin_defaults
 from spicy.core.profile.decorators import is_staff
 from spicy.core.service import api
+from spicy.core.siteskin import defaults as sk_defaults
 from spicy.core.siteskin.decorators import ajax_request, render_to
 from spicy.utils import NavigationFilter
-from . import models, defaults, utils
+from . import caching, models, defaults, listeners, registry, timeline, utils
+
+
+def get_cursor_page(request, queryset, per_page):
+    try:
+        return utils.paginate_by_cursor(
+            queryset, request.GET, per_page,
+            count_limit=defaults.HISTORY_COUNT_LIMIT)
+    except ValueError:
+        raise Http404(unicode(_('Page does not exist.')))
+
+
+def to_field_value(consumer, field, text):
+    """
+    Convert ``text`` of the ``consumer`` field stored in history back to a
+    value of the attribute.
+    """
+    model_field = getattr(consumer.__class__, field, None)
+    if model_field:
+        if callable(model_field):
+            raise ValueError("Unable to convert to a function")
+        elif isinstance(
+                model_field, related.ReverseSingleRelatedObjectDescriptor):
+            to_type = model_field.field.rel.to
+        else:
+            to_type = unicode
+    else:
+        to_type = getattr(consumer, field).__class__
+    return utils.from_unicode(text, to_type)
 
 
 class HistoryProvider(api.Provider):
@@ -35,15 +65,26 @@ class HistoryProvider(api.Provider):
             consumer_type__model=consumer_type) & Q(
             consumer_id=consumer_id)
         nav = NavigationFilter(request)
-        paginator_base_url = '.'
-        paginator = nav.get_queryset_with_paginator(
-            self.model, paginator_base_url,
-            obj_per_page=admin_defaults.ADMIN_OBJECTS_PER_PAGE,
-            search_query=search_query)
-        objects_list = paginator.current_page.object_list
+        if defaults.HISTORY_CURSOR_PAGINATION:
+            paginator = None
+            cursor_page = get_cursor_page(
+                request, models.Action.objects.prefetch_consumers(
+                    ).prefetch_related('diff_set').filter(search_query),
+                admin_defaults.ADMIN_OBJECTS_PER_PAGE)
+            objects_list = cursor_page.object_list
+        else:
+            cursor_page = None
+            paginator_base_url = '.'
+            paginator = nav.get_queryset_with_paginator(
+                self.model, paginator_base_url,
+                obj_per_page=admin_defaults.ADMIN_OBJECTS_PER_PAGE,
+                search_query=search_query)
+            objects_list = models.Action.objects.prefetch(
+                paginator.current_page.object_list)
 
         return {
             'nav': nav, 'objects_list': objects_list, 'paginator': paginator,
+            'cursor_page': cursor_page, 'use_cursor': cursor_page is not None,
             'consumer': consumer, 'consumer_type_id': ctype.id,
             'fields': defaults.OBSERVED_FIELDS.get(
                 '.'.join((
@@ -59,7 +100,8 @@ class HistoryProvider(api.Provider):
         ctype = ContentType.objects.get(model=consumer_type)
         consumer_model = ctype.model_class()
         consumer = consumer_model.objects.get(pk=consumer_id)
-        provs = self.model.objects.filter(
+        provs = models.Action.objects.prefetch_consumers().prefetch_related(
+            'diff_set').filter(
             consumer_type__model=consumer_type,
             consumer_id=consumer_id, diff__field=field)
         return dict(provs=provs, consumer=consumer)
@@ -67,57 +109,28 @@ class HistoryProvider(api.Provider):
     @is_staff(required_perms='history.rollback')
     @ajax_request('/(?P<diff_id>[\d]+)/rollback/$')
     def rollback(self, request, diff_id):
-        status = 'ok'
-        message = ''
-
-        diff = models.Diff.objects.get(pk=diff_id)
-        action = models.Action.objects.create(
-            action_type=defaults.ACTION_ROLLBACK,
-            consumer_type_id=diff.action.consumer_type_id,
-            consumer_id=diff.action.consumer_id,
-            profile=request.user, rollback_to=diff,
-            ip=request.META.get('REMOTE_ADDR'))
-
-        last_diff = diff.last_version
-        last_date = last_diff.action.date_joined
-        last_value = utils.to_unicode(
-            getattr(diff.action.consumer, diff.field))
-        new_value = diff.get_version_text()
-
-        if new_value == last_value:
+        diff = models.Diff.objects.fill_consumers(
+            [models.Diff.objects.select_related('action').get(pk=diff_id)])[0]
+        return self._rollback(request, api.register['history'].rollback(
+            [diff], profile=request.user,
+            ip=request.META.get('REMOTE_ADDR')))
+
+    @is_staff(required_perms='history.rollback')
+    @ajax_request('/actions/(?P<action_id>[\d]+)/rollback/$')
+    def revert(self, request, action_id):
+        action = models.Action.objects.get(pk=action_id)
+        return self._rollback(
+            request, api.register['history'].rollback_to_action(
+                action, profile=request.user,
+                ip=request.META.get('REMOTE_ADDR')))
+
+    def _rollback(self, request, action):
+        if action is None:
             return {
                 'status': 'error',
                 'message': unicode(_('Old version matches current version'))}
-
-        consumer_name = unicode(action.consumer).encode('utf-8')
-        diff_text = '\n'.join(difflib.unified_diff(
-            last_value.encode('utf-8').splitlines(),
-            new_value.encode('utf-8').splitlines(),
-            consumer_name, consumer_name, last_date,
-            unicode(action.date_joined).encode('utf-8'), lineterm=''))
-        models.Diff.objects.create(
-            action=action, version=last_diff.version + 1,
-            change=diff_text, field=diff.field)
-        model = action.consumer_type.model_class()
-        field = diff.field
-        model_field = getattr(model, field, None)
-        if model_field:
-            if callable(model_field):
-                raise ValueError("Unable to convert to a function")
-            elif isinstance(
-                    model_field, related.ReverseSingleRelatedObjectDescriptor):
-                to_type = model_field.field.rel.to
-            else:
-                to_type = unicode
-        else:
-            to_type = getattr(action.consumer, diff.field).__class__
-
-        setattr(
-            action.consumer, field, utils.from_unicode(new_value, to_type))
-        action.consumer._action_type = defaults.ACTION_ROLLBACK
-        action.consumer.save()
         return dict(
-            status=status, message=message,
+            status='ok', message='',
             next_url=reverse(
                 'history:admin:action', args=[action.pk]))
 
@@ -134,7 +147,8 @@ class HistoryProvider(api.Provider):
         ctype = ContentType.objects.get(model=consumer_type)
         consumer_model = ctype.model_class()
         consumer = consumer_model.objects.get(pk=consumer_id)
-        objects_list = self.model.objects.filter(
+        objects_list = models.Action.objects.prefetch_consumers(
+            ).prefetch_related('diff_set').filter(
             consumer_type__model=consumer_type,
             consumer_id=consumer_id)
 
@@ -176,86 +190,95 @@ class HistoryProvider(api.Provider):
 
     def _timeline(
             self, request, consumer_types, root, attr_name=None, attr_id=None):
-        # Templates are cached in a dict.
-        templates = defaultdict(
-            lambda: get_template(
-                'spicy.history/providers/%s.html' % template_name))
-
-        # TODO custom SQL for consumer.root checking
-        consumer_types_list = consumer_types.split(',')
-        actions = models.Action.objects.filter(
-            show_in_timeline=True,
-            consumer_type__model__in=consumer_types_list,
-            action_type__in=[0, 1],
-            ).order_by('-date_joined')
-
-        if attr_name is not None and attr_id is not None:
-            queries = []
-            action_ids = []
-            for ctype_string in consumer_types_list:
-                ctype = ContentType.objects.get(model=ctype_string)
-                consumers = getattr(ctype.model_class(), 'objects').all()
-                
-                action_ids.extend(actions.filter(
-                    consumer_type__id=ctype.id,
-                    consumer_id__in=consumers.filter(
-                        is_public=True,
-                        **{attr_name: attr_id}).values_list('id', flat=True)
-                    ).values_list('id', flat=True))
-                            
-            actions = actions.filter(
-                pk__in=[aid for aid in action_ids])
-
-        elif len(consumer_types_list) == 1:
-            manager = (
-                'with_attrs' if consumer_types == 'tag' else 'objects')
-            ctype = ContentType.objects.get(model=consumer_types)
-            consumers = getattr(ctype.model_class(), manager).all()
-            if root:
-                queries = []
-                key = 'term__slug'
-                for i in xrange(defaults.GEOTARGET_TAG_ROOT_DEPTH):
-                    key = 'vocabulary__' + key
-                    queries.append(Q(**{key: root}))
-                consumers = consumers.filter(
-                    reduce(operator.or_, queries), is_public=True)
-
-            actions = actions.filter(
-                consumer_id__in=[consumer.id for consumer in consumers])
-            consumers_dict = dict(
-                (consumer.id, consumer) for consumer in consumers)
-            for action in actions:
-                action.consumer = consumers_dict[action.consumer_id]
-        
-        providers = []
-        for action in actions:
-            if action.consumer and action.consumer.check_public():
-                if root and hasattr(action.consumer, 'root'):
-                    if action.consumer.root is None or (
-                            action.consumer.root and
-                            action.consumer.root.slug != root):
-                        continue
-
-                template_name = action.consumer.get_history_template(
-                    action.action_type)
-                context = Context({
-                    'action': action, 'consumer': action.consumer})
-                template = templates[template_name]
-                action.rendered_template = template.render(context)
-                providers.append(action)
+        content_types = list(ContentType.objects.filter(
+            model__in=consumer_types.split(',')))
+        key = timeline.get_key(root, attr_name, attr_id)
+        cache_key = None
+        # Attribute changes don't expire pages of timelines filtered by them.
+        if (caching.is_page_cache_enabled() and
+                request.user.is_anonymous() and
+                timeline.is_stored(content_types, root, attr_name)):
+            cache_key = caching.get_page_key(consumer_types, key, request.GET)
+            context = caching.cache.get(cache_key)
+            if context is not None:
+                return context
+
+        context = self._get_timeline(
+            request, consumer_types, root, timeline.get_entries(
+                content_types, root, attr_name, attr_id))
+        if cache_key is not None:
+            caching.set_page(cache_key, context)
+        return context
+
+    def _get_timeline(self, request, consumer_types, root, entries):
+        entries = entries.select_related('action').order_by(
+            '-date_joined', '-id')
+
+        if defaults.HISTORY_CURSOR_PAGINATION:
+            cursor_page = get_cursor_page(
+                request, entries, sk_defaults.OBJECTS_PER_PAGE)
+            return dict(
+                paginator=None, cursor_page=cursor_page, use_cursor=True,
+                actions=self._render_actions(
+                    [entry.action for entry in cursor_page.object_list]),
+                consumer_types=consumer_types, root=root)
 
         page = request.GET.get('page', 1)
-        paginator = Paginator(providers, sk_defaults.OBJECTS_PER_PAGE)
+        paginator = Paginator(entries, sk_defaults.OBJECTS_PER_PAGE)
 
         try:
             paginator.current_page = paginator.page(page)
         except InvalidPage:
             raise Http404(unicode(_('Page %s does not exist.' % page)))
+        paginator.current_page.object_list = self._render_actions(
+            [entry.action for entry in paginator.current_page.object_list])
         #paginator.base_url = reverse(
         #     'service:public:history-timeline', args=[consumer_types, root])
 
         return dict(
-            paginator=paginator, consumer_types=consumer_types, root=root)
+            paginator=paginator, use_cursor=False,
+            actions=paginator.current_page.object_list,
+            consumer_types=consumer_types, root=root)
+
+    def _render_actions(self, actions):
+        keys = caching.get_entry_keys(actions)
+        cached = caching.get_rendered(keys)
+
+        # Consumers of cached entries are still loaded to check them.
+        checked = set(
+            action.id for action in actions if hasattr(
+                ContentType.objects.get_for_id(
+                    action.consumer_type_id).model_class(), 'check_public'))
+        models.Action.objects.attach_consumers(
+            [action for action in actions
+             if action.id not in cached or action.id in checked],
+            manager='with_attrs')
+
+        # Templates are cached in a dict.
+        templates = {}
+        providers = []
+        rendered = {}
+        for action in actions:
+            if action.id in checked and not (
+                    action.consumer and timeline.is_public(action.consumer)):
+                continue
+            if action.id in cached:
+                action.rendered_template = cached[action.id]
+                providers.append(action)
+                continue
+            consumer = action.consumer
+            if consumer is None:
+                continue
+            template_name = consumer.get_history_template(action.action_type)
+            if template_name not in templates:
+                templates[template_name] = get_template(
+                    'spicy.history/providers/%s.html' % template_name)
+            context = Context({'action': action, 'consumer': consumer})
+            action.rendered_template = rendered[action.id] = templates[
+                template_name].render(context)
+            providers.append(action)
+        caching.set_rendered(keys, rendered)
+        return providers
 
 
 class HistoryService(api.Interface):
@@ -266,11 +289,169 @@ class HistoryService(api.Interface):
 
     schema = dict(GENERIC_CONSUMER=HistoryProvider)
 
+    def batch(self):
+        """
+        Context manager buffering history of all saves made in it, see
+        ``listeners.batch``.
+        """
+        return listeners.batch()
+
+    def rollback(self, diffs, profile=None, ip=None):
+        """
+        Roll fields of a consumer back to versions of ``diffs`` and return the
+        rollback action, or None if the fields have that text already.
+
+        Target versions are rebuilt from their nearest snapshots and diffed
+        against the last recorded text. The action, its diffs and the
+        consumer are saved in one transaction.
+        """
+        diffs = models.Diff.objects.fill_consumers(list(diffs))
+        if not diffs:
+            return
+        consumer_type_id, consumer_id = (
+            diffs[0].consumer_type_id, diffs[0].consumer_id)
+        # Pending changes must get their versions before the rollback does.
+        listeners.process_pending(models.PendingChange.objects.filter(
+            action__consumer_type__id=consumer_type_id,
+            action__consumer_id=consumer_id).order_by('pk'))
+
+        with transaction.commit_on_success():
+            consumer = diffs[0].action.consumer
+            consumer_name = unicode(consumer).encode('utf-8')
+            action = None
+            for diff in diffs:
+                head = models.Head.objects.get_for(
+                    consumer_type_id, consumer_id, diff.field,
+                    for_update=True)
+                if diff.version == head.version:
+                    continue
+                new_value = diff.get_version_text()
+                if (utils.split_lines(new_value) ==
+                        utils.split_lines(head.text)):
+                    continue
+
+                if action is None:
+                    action = models.Action.objects.create(
+                        action_type=defaults.ACTION_ROLLBACK,
+                        consumer_type_id=consumer_type_id,
+                        consumer_id=consumer_id, profile=profile,
+                        rollback_to=diff, ip=ip)
+                new_diff = action.make_diff(
+                    diff.field, head.version + 1, listeners.make_patch(
+                        head.text.encode('utf-8'), new_value.encode('utf-8'),
+                        consumer_name, head.date or '', action.date_joined))
+                new_diff.save()
+                head.advance(new_diff, utils.join_lines(new_value))
+                setattr(consumer, diff.field, to_field_value(
+                    consumer, diff.field, new_value))
+
+            if action is not None:
+                consumer._action_type = defaults.ACTION_ROLLBACK
+                consumer.save()
+            return action
+
+    def rollback_to_action(self, action, profile=None, ip=None):
+        """
+        Roll all fields of the consumer back to their versions right after
+        ``action``, see ``rollback``.
+        """
+        models.Diff.objects.denormalize(
+            action.consumer_type_id, action.consumer_id)
+        versions = models.Diff.objects.filter(
+            consumer_type__id=action.consumer_type_id,
+            consumer_id=action.consumer_id, action__id__lte=action.id,
+            ).values('field').annotate(last_version=Max('version'))
+        if not versions:
+            return
+        diffs = models.Diff.objects.select_related('action').filter(
+            reduce(operator.or_, (
+                Q(field=version['field'], version=version['last_version'])
+                for version in versions)),
+            consumer_type__id=action.consumer_type_id,
+            consumer_id=action.consumer_id)
+        return self.rollback(diffs, profile=profile, ip=ip)
+
+    def get_state_at(self, consumer, when, as_instance=False):
+        """
+        Return a dict of observed field texts of ``consumer`` at ``when``, or
+        an unsaved copy of it with these values if ``as_instance`` is set.
+        Fields with no versions recorded by then are left out (or keep their
+        current values).
+
+        Versions are resolved with one query. Fields whose version is still
+        the last one are taken from heads, the rest are rebuilt from their
+        nearest snapshots.
+        """
+        observation = registry.get(consumer.__class__)
+        if observation is None:
+            fields = ()
+        elif observation.is_timeline:
+            fields = observation.fields | observation.timeline_fields
+        else:
+            fields = observation.fields
+        consumer_type_id = ContentType.objects.get_for_model(consumer).id
+        models.Diff.objects.denormalize(consumer_type_id, consumer.pk)
+
+        versions = dict(
+            (version['field'], version['last_version'])
+            for version in models.Diff.objects.filter(
+                consumer_type__id=consumer_type_id, consumer_id=consumer.pk,
+                field__in=fields, action__date_joined__lte=when,
+                ).values('field').annotate(last_version=Max('version')))
+        state = dict(
+            (head.field, head.text) for head in models.Head.objects.filter(
+                consumer_type__id=consumer_type_id, consumer_id=consumer.pk,
+                field__in=versions)
+            if head.version == versions[head.field])
+        for field, version in versions.iteritems():
+            if field not in state:
+                for _version, action, text in (
+                        models.Diff.objects.iter_versions(
+                            consumer_type_id, consumer.pk, field, version,
+                            version)):
+                    state[field] = text
+
+        if not as_instance:
+            return state
+        instance = copy.copy(consumer)
+        for field, text in state.iteritems():
+            setattr(instance, field, to_field_value(consumer, field, text))
+        return instance
+
+    def compare(self, consumer, field, old, new):
+        """
+        Return unified diff of the ``consumer`` field between two versions,
+        given as numbers or as datetimes to take versions current at them.
+        """
+        consumer_type_id = ContentType.objects.get_for_model(consumer).id
+        versions = [
+            models.Diff.objects.get_version_at(
+                consumer_type_id, consumer.pk, field, value)
+            if isinstance(value, datetime.datetime) else value
+            for value in (old, new)]
+        return models.Diff.objects.compare(
+            consumer_type_id, consumer.pk, field, *versions)
+
+    def iter_versions(self, consumer, field, start=1, end=None):
+        """
+        Yield ``(version, action, text)`` for versions of the ``consumer``
+        field from ``start`` to ``end``, see ``DiffManager.iter_versions``.
+        """
+        return models.Diff.objects.iter_versions(
+            ContentType.objects.get_for_model(consumer).id, consumer.pk,
+            field, start, end)
+
     def get_last_version(self, consumer_type, consumer_id, field):
+        try:
+            return models.Head.objects.filter(
+                consumer_type__model=consumer_type, consumer_id=consumer_id,
+                field=field).values_list('version', flat=True)[0]
+        except IndexError:
+            pass
         try:
             return models.Diff.objects.filter(
-                action__consumer_type__model=consumer_type,
-                action__consumer_id=consumer_id, field=field
+                consumer_type__model=consumer_type,
+                consumer_id=consumer_id, field=field
                 ).order_by('-version')[0].version
         except IndexError:
             return 0
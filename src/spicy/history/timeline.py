@@ -0,0 +1,172 @@
+"""
+Public timeline entries maintained on every save of timeline observed
+objects, so timeline pages are plain indexed reads.
+
+Every action is stored once per timeline key it belongs to: empty key for
+the timeline of all objects of its type, ``root:<slug>`` for the rubric
+timeline and ``<attr name>:<attr id>`` for attribute timelines listed in
+TIMELINE_ATTRS. Other attribute timelines are read from the timeline of the
+type, filtered by the current attribute values of objects.
+
+Entries hold the ``is_public`` flag of objects. Objects with a
+``check_public()`` method are also checked whenever their entries are shown,
+since the result may change without a save (e.g. with publication dates).
+"""
+import operator
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from . import caching, defaults, registry
+
+
+ROOT_KEY = u'root:%s'
+
+ATTR_KEY = u'%s:%s'
+
+TIMELINE_ACTIONS = (defaults.ACTION_CREATE, defaults.ACTION_EDIT)
+
+
+def get_key(root=None, attr_name=None, attr_id=None):
+    if root:
+        return ROOT_KEY % root
+    elif attr_name is not None and attr_id is not None:
+        return ATTR_KEY % (attr_name, attr_id)
+    return u''
+
+
+def get_state(instance):
+    """
+    Return timeline keys of the object and whether it is public.
+    """
+    keys = set([get_key()])
+
+    root = getattr(instance, 'root', None)
+    if root is not None:
+        keys.add(get_key(root=root.slug))
+
+    model = instance.__class__
+    label = registry.get_label(model)
+    for attr_name in defaults.TIMELINE_ATTRS.get(label, ()):
+        keys.update(
+            get_key(attr_name=attr_name, attr_id=attr_id)
+            for attr_id in model._default_manager.filter(
+                pk=instance.pk).values_list(attr_name, flat=True)
+            if attr_id is not None)
+
+    return keys, bool(getattr(instance, 'is_public', True))
+
+
+def is_public(consumer):
+    """
+    Return True if ``consumer`` may be shown in public timelines, see
+    ``check_public()``.
+    """
+    return not hasattr(consumer, 'check_public') or consumer.check_public()
+
+
+def is_stored(consumer_types, root=None, attr_name=None):
+    """
+    Return True if timeline entries of ``consumer_types`` (content types)
+    are stored under the key of the timeline.
+    """
+    return bool(root) or not attr_name or all(
+        attr_name in defaults.TIMELINE_ATTRS.get(
+            registry.get_label(consumer_type.model_class()), ())
+        for consumer_type in consumer_types)
+
+
+def get_entries(consumer_types, root=None, attr_name=None, attr_id=None):
+    """
+    Return public timeline entries of ``consumer_types`` (content types).
+    """
+    from . import models
+    entries = models.TimelineEntry.objects.filter(is_public=True)
+    if is_stored(consumer_types, root, attr_name):
+        return entries.filter(
+            consumer_type__in=consumer_types,
+            key=get_key(root, attr_name, attr_id))
+
+    lookups = []
+    for consumer_type in consumer_types:
+        if is_stored([consumer_type], root, attr_name):
+            lookup = Q(key=get_key(attr_name=attr_name, attr_id=attr_id))
+        else:
+            model = consumer_type.model_class()
+            lookup = Q(
+                key=get_key(),
+                consumer_id__in=model._default_manager.filter(
+                    **{attr_name: attr_id}).values('pk'))
+        lookups.append(Q(consumer_type=consumer_type) & lookup)
+    return entries.filter(reduce(operator.or_, lookups))
+
+
+def is_timeline_observed(instance):
+    observation = registry.get(instance.__class__)
+    return observation is not None and observation.is_timeline
+
+
+def sync(consumer_type_id, consumer_id, keys, is_public):
+    """
+    Bring timeline entries of the object in line with its actions, keys and
+    public flag.
+    """
+    from . import models
+
+    actions = dict(models.Action.objects.filter(
+        consumer_type__id=consumer_type_id, consumer_id=consumer_id,
+        show_in_timeline=True, action_type__in=TIMELINE_ACTIONS
+        ).values_list('id', 'date_joined'))
+    entries = models.TimelineEntry.objects.filter(
+        consumer_type__id=consumer_type_id, consumer_id=consumer_id)
+
+    stored = set()
+    stale = []
+    flipped = []
+    changed_keys = set(keys)
+    for pk, action_id, key, entry_public in entries.values_list(
+            'pk', 'action', 'key', 'is_public'):
+        changed_keys.add(key)
+        if action_id in actions and key in keys:
+            stored.add((action_id, key))
+            if entry_public != is_public:
+                flipped.append(pk)
+        else:
+            stale.append(pk)
+
+    if stale:
+        entries.filter(pk__in=stale).delete()
+    if flipped:
+        entries.filter(pk__in=flipped).update(is_public=is_public)
+    missing = [
+        models.TimelineEntry(
+            action_id=action_id, consumer_type_id=consumer_type_id,
+            consumer_id=consumer_id, key=key, is_public=is_public,
+            date_joined=date_joined)
+        for action_id, date_joined in actions.iteritems()
+        for key in keys if (action_id, key) not in stored]
+    if missing:
+        models.TimelineEntry.objects.bulk_create(missing)
+    caching.invalidate_timelines(changed_keys)
+
+
+def update(instance):
+    """
+    Sync timeline entries of a saved object.
+    """
+    if is_timeline_observed(instance):
+        keys, is_public = get_state(instance)
+        sync(
+            ContentType.objects.get_for_model(instance).id, instance.pk,
+            keys, is_public)
+
+
+def remove(instance):
+    """
+    Drop timeline entries of an object being deleted.
+    """
+    from . import models
+    if is_timeline_observed(instance):
+        entries = models.TimelineEntry.objects.filter(
+            consumer_type=ContentType.objects.get_for_model(instance),
+            consumer_id=instance.pk)
+        caching.invalidate_timelines(entries.values_list('key', flat=True))
+        entries.delete()
@@ -6,6 +6,10 @@ admin_urls = patterns(
     url(r'^$', 'actions_list', name='index'),
     url(r'^actions/(?P<action_id>\d+)/$', 'view_action', name='action'),
     url(r'^diffs/(?P<diff_id>\d+)/$', 'view_diff', name='diff'),
+    url(r'^diffs/(?P<diff_id>\d+)/blame/$', 'blame_diff', name='blame'),
+    url(r'^diffs/(?P<diff_id>\d+)/compare/$', 'compare_diff',
+        name='compare'),
+    url(r'^export/$', 'export_history', name='export'),
 )
 
 urlpatterns = patterns(
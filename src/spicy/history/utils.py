@@ -1,14 +1,21 @@
 import datetime
+import hashlib
+import operator
 import re
+from functools import reduce
 from django.db.models import Model, Q
 
 
-HUNK_RE = '@@ \-(\d+)(,(\d+))? \+(\d+)(,(\d+))? @@'
+HUNK_RE = re.compile('@@ \-(\d+)(,(\d+))? \+(\d+)(,(\d+))? @@')
 
+OP_COPY, OP_SKIP, OP_INSERT = range(3)
 
-def merge(diffs):
+
+def merge(diffs, base=u'', strict=True):
     """
-    Apply multiple diffs.
+    Apply multiple diffs, starting from ``base`` text (e.g. a snapshot).
+    Context and removed lines are checked against the text unless ``strict``
+    is unset.
 
     Add one line:
     >>> merge([
@@ -120,74 +127,355 @@ def merge(diffs):
     ... '-<p>12323arsar</p>\\n'
     ... '-<p>arsars</p>'])
     u'<p>qqZZZ</p>'
+
+    Start from a snapshot:
+    >>> merge([
+    ...     '--- \\n'
+    ...     '+++ \\n'
+    ...     '@@ -1,2 +1,2 @@\\n'
+    ...     ' qwf\\n'
+    ...     '-zxc\\n'
+    ...     '+ars'], u'qwf\\nzxc')
+    u'qwf\\nars'
     """
-    hunk_re = re.compile(HUNK_RE)
-    text = []
+    text = split_text(base)
     for diff in diffs:
-        text_new = text[:]
-        lines = (line for line in diff.splitlines())
-        line = ''
-        while line is not None:
-            try:
-                line = lines.next()
-                if line.startswith('--- '):
-                    lines.next()
-                    line = lines.next()
-
-                # Parse hunk info.
-                match = hunk_re.match(line)
-                if match is None:
-                    continue
-
-                (start_old, has_size_old, size_old, start_new, has_size_new,
-                 size_new) = match.groups()
-
-                if has_size_old is None:
-                    size_old = 1
-
-                if has_size_new is None:
-                    size_new = 1
-
-                start_old, size_old, start_new, size_new = map(
-                    int, (start_old, size_old, start_new, size_new))
-
-                start_old -= 1
-                start_new -= 1
-
-                # Parse hunk.
-                end_new = start_new + size_new
-                end_old = start_old + size_old
-                while start_new < end_new or start_old < end_old:
-                    line = lines.next()
-                    
-                    if line.startswith('-'):
-                        # Line removed.
-                        # XXX
-                        assert text[start_old] == line[1:],\
-                            "Deleted text didn't match: %s\n%s" % (
-                                unicode(text), line)
-                        del text_new[start_new]
-                        start_old += 1
-                        pass
-                        
-                    elif line.startswith('+'):
-                        # Line added.
-                        text_new.insert(start_new, line[1:])
-                        start_new += 1
-                        
-                    else:
-                        # Line unchanged.
-                        line = line[1:]
-                        assert text[start_old] == text_new[start_new] == line,\
-                            "Text shouldn't change here: %s\n%s" % (
-                                diff, unicode((text[start_old], line, text)))
-                        start_old += 1
-                        start_new += 1
-            except StopIteration:
-                line = None
-        text = text_new
-
-    return u'\n'.join(line for line in text if line is not None)
+        text = apply_patch(text, compile_patch(diff, strict))
+    return u'\n'.join(text)
+
+
+def compile_patch(diff, strict=True):
+    """
+    Parse unified diff into a list of ``(op, count, lines)`` opcodes which
+    copy or skip ``count`` lines of the old text or insert new ``lines``.
+    Lines of copied context and skipped text are only kept if ``strict`` is
+    set, so they can be checked when the patch is applied.
+
+    >>> compile_patch(
+    ...     '--- \\n'
+    ...     '+++ \\n'
+    ...     '@@ -2,3 +2,3 @@\\n'
+    ...     ' 22\\n'
+    ...     '-33\\n'
+    ...     '+ab\\n'
+    ...     ' 44')
+    [(0, 1, None), (0, 1, ['22']), (1, 1, ['33']), (2, 1, ['ab']), (0, 1, ['44'])]
+    >>> compile_patch(
+    ...     '--- \\n'
+    ...     '+++ \\n'
+    ...     '@@ -0,0 +1,2 @@\\n'
+    ...     '+qwf\\n'
+    ...     '+ars', strict=False)
+    [(2, 2, ['qwf', 'ars'])]
+    """
+    ops = []
+    lines = diff.splitlines()
+    count = len(lines)
+    i = 0
+    # Position in the old text and difference between new and old positions.
+    pos = delta = 0
+    while i < count:
+        line = lines[i]
+        i += 1
+        match = HUNK_RE.match(line) if line.startswith('@@') else None
+        if match is None:
+            continue
+
+        (start_old, has_size_old, size_old, start_new, has_size_new,
+         size_new) = match.groups()
+        size_old = 1 if has_size_old is None else int(size_old)
+        size_new = 1 if has_size_new is None else int(size_new)
+
+        # Start of an empty range is formatted differently by different
+        # versions of difflib, so the new one is used for pure insertions.
+        if size_old:
+            start = int(start_old) - 1
+        else:
+            start = int(start_new) - 1 - delta
+        if start > pos:
+            ops.append((OP_COPY, start - pos, None))
+        pos = start + size_old
+        delta += size_new - size_old
+
+        run_op, run = None, []
+        old_left, new_left = size_old, size_new
+        while (old_left > 0 or new_left > 0) and i < count:
+            line = lines[i]
+            i += 1
+            if line.startswith('-'):
+                op = OP_SKIP
+                old_left -= 1
+            elif line.startswith('+'):
+                op = OP_INSERT
+                new_left -= 1
+            else:
+                op = OP_COPY
+                old_left -= 1
+                new_left -= 1
+            if op != run_op and run:
+                ops.append(_make_op(run_op, run, strict))
+                run = []
+            run_op = op
+            run.append(line[1:])
+        if run:
+            ops.append(_make_op(run_op, run, strict))
+    return ops
+
+
+def _make_op(op, lines, strict):
+    return op, len(lines), lines if strict or op == OP_INSERT else None
+
+
+def apply_patch(text, ops):
+    """
+    Apply opcodes produced by ``compile_patch`` to a list of lines and return
+    a new list.
+
+    >>> apply_patch(['11', '22', '33'], [(0, 1, None), (1, 1, ['22'])])
+    ['11', '33']
+    >>> apply_patch(['11', '22'], [(1, 1, ['33'])])
+    Traceback (most recent call last):
+        ...
+    AssertionError: Deleted text didn't match: ['11']
+    ['33']
+    """
+    result = []
+    pos = 0
+    for op, count, lines in ops:
+        if op == OP_INSERT:
+            result.extend(lines)
+            continue
+
+        end = pos + count
+        if lines is None:
+            assert end <= len(text), "Patch doesn't match text length"
+        elif op == OP_SKIP:
+            assert text[pos:end] == lines,\
+                "Deleted text didn't match: %s\n%s" % (
+                    text[pos:end], lines)
+        else:
+            assert text[pos:end] == lines,\
+                "Text shouldn't change here: %s\n%s" % (
+                    text[pos:end], lines)
+        if op == OP_COPY:
+            result.extend(text[pos:end])
+        pos = end
+    result.extend(text[pos:])
+    return result
+
+
+def apply_blame(origins, ops, origin):
+    """
+    Apply opcodes to a list of origins of text lines, in step with
+    ``apply_patch`` applying them to the text: copied lines keep their
+    origins and inserted lines get ``origin``.
+
+    >>> apply_blame(
+    ...     [1, 1, 2], [(0, 1, None), (1, 1, None), (2, 2, ['x', 'y'])], 3)
+    [1, 3, 3, 2]
+    """
+    result = []
+    pos = 0
+    for op, count, lines in ops:
+        if op == OP_INSERT:
+            result.extend([origin] * len(lines))
+            continue
+        end = pos + count
+        if op == OP_COPY:
+            result.extend(origins[pos:end])
+        pos = end
+    result.extend(origins[pos:])
+    return result
+
+
+def make_net_patch(old, new, origins):
+    """
+    Return opcodes turning ``old`` lines into ``new`` ones, where
+    ``origins`` are indexes of old lines the new ones were copied from, or
+    None for inserted lines (see ``apply_blame``). Lines deleted and then
+    inserted back unchanged are copied.
+
+    >>> make_net_patch(
+    ...     ['a', 'b', 'c'], ['x', 'a', 'c', 'y'], [None, 0, 2, None])
+    [(2, 1, ['x']), (0, 1, ['a']), (1, 1, ['b']), (0, 1, ['c']), (2, 1, ['y'])]
+    >>> make_net_patch(['a', 'b'], ['a', 'b'], [0, None])
+    [(0, 2, ['a', 'b'])]
+    """
+    ops = []
+    copied = []
+    inserted = []
+    pos = 0
+    for line, origin in zip(new, origins) + [(None, len(old))]:
+        if origin is None:
+            inserted.append(line)
+            continue
+
+        skipped = old[pos:origin]
+        if skipped == inserted:
+            copied.extend(skipped)
+            inserted = []
+        else:
+            if copied:
+                ops.append(_make_op(OP_COPY, copied, True))
+                copied = []
+            if skipped:
+                ops.append(_make_op(OP_SKIP, skipped, True))
+            if inserted:
+                ops.append(_make_op(OP_INSERT, inserted, True))
+                inserted = []
+        if origin < len(old):
+            copied.append(line)
+        pos = origin + 1
+    if copied:
+        ops.append(_make_op(OP_COPY, copied, True))
+    return ops
+
+
+PACKED_OPS = {OP_COPY: '=', OP_SKIP: '-', OP_INSERT: '+'}
+
+UNPACKED_OPS = dict((value, key) for key, value in PACKED_OPS.iteritems())
+
+
+def pack_patch(ops):
+    """
+    Encode opcodes without context lines. Every opcode is a line with its
+    type and count, followed by removed or inserted lines.
+
+    >>> pack_patch(compile_patch(
+    ...     '--- \\n'
+    ...     '+++ \\n'
+    ...     '@@ -2,3 +2,3 @@\\n'
+    ...     ' 22\\n'
+    ...     '-33\\n'
+    ...     '+ab\\n'
+    ...     ' 44'))
+    '=2\\n-1\\n33\\n+1\\nab'
+    """
+    packed = []
+    copy = 0
+    for op, count, lines in ops:
+        if op == OP_COPY:
+            copy += count
+            continue
+        if copy:
+            packed.append('=%d' % copy)
+            copy = 0
+        packed.append('%s%d' % (PACKED_OPS[op], count))
+        packed.extend(lines)
+    return '\n'.join(packed)
+
+
+def unpack_patch(packed, strict=True):
+    """
+    Decode opcodes encoded by ``pack_patch``. Removed lines are only kept if
+    ``strict`` is set.
+
+    >>> unpack_patch(u'=2\\n-1\\n33\\n+1\\nab')
+    [(0, 2, None), (1, 1, [u'33']), (2, 1, [u'ab'])]
+    """
+    ops = []
+    lines = packed.split(u'\n') if packed else []
+    i = 0
+    while i < len(lines):
+        op, count = UNPACKED_OPS[lines[i][0]], int(lines[i][1:])
+        i += 1
+        if op == OP_COPY:
+            ops.append((op, count, None))
+        else:
+            ops.append(_make_op(op, lines[i:i + count], strict))
+            i += count
+    return ops
+
+
+def get_patch_ops(change, packed=None, strict=True):
+    """
+    Return opcodes of a patch stored either packed or as unified diff text.
+    """
+    if packed:
+        return unpack_patch(packed, strict)
+    return compile_patch(change, strict)
+
+
+def render_patch(ops):
+    """
+    Render opcodes as a unified diff without context lines.
+
+    >>> print render_patch(unpack_patch(u'=2\\n-1\\n33\\n+2\\nab\\ncd'))
+    --- 
+    +++ 
+    @@ -3 +3,2 @@
+    -33
+    +ab
+    +cd
+    """
+    result = ['--- ', '+++ ']
+    old = new = 0
+    hunk = None
+    for op, count, lines in ops + [(OP_COPY, 0, None)]:
+        if op == OP_COPY:
+            if hunk is not None:
+                old_start, new_start, hunk_lines = hunk
+                result.append('@@ -%s +%s @@' % (
+                    _format_range(old_start, old - old_start),
+                    _format_range(new_start, new - new_start)))
+                result.extend(hunk_lines)
+                hunk = None
+            old += count
+            new += count
+            continue
+
+        if hunk is None:
+            hunk = old, new, []
+        if op == OP_SKIP:
+            hunk[2].extend(u'-' + line for line in lines)
+            old += count
+        else:
+            hunk[2].extend(u'+' + line for line in lines)
+            new += count
+    return u'\n'.join(result)
+
+
+def _format_range(start, length):
+    if length == 1:
+        return '%d' % (start + 1)
+    return '%d,%d' % (start + 1 if length else start, length)
+
+
+def split_text(text):
+    """
+    Split text produced by ``merge`` back into lines.
+
+    >>> split_text(u'')
+    []
+    >>> split_text(u'qwf\\n\\nars')
+    [u'qwf', u'', u'ars']
+    """
+    return text.split(u'\n') if text else []
+
+
+def split_lines(value):
+    """
+    Split a value into lines for diffing. A single empty line is the same as
+    no lines at all, since both are merged back into an empty text.
+
+    >>> split_lines('qwf\\r\\nars\\n')
+    ['qwf', 'ars']
+    >>> split_lines('\\n')
+    []
+    """
+    lines = value.splitlines()
+    return [] if lines == [''] else lines
+
+
+def join_lines(value):
+    """
+    Normalize a value the same way as storing it as a patch and merging it
+    back does.
+
+    >>> join_lines('qwf\\r\\nars\\n')
+    'qwf\\nars'
+    """
+    return '\n'.join(split_lines(value))
 
 
 def to_unicode(value):
@@ -282,6 +570,169 @@ def from_unicode(value, to_type):
         raise NotImplementedError
 
 
+def get_field_hashes(instance, fields):
+    """
+    Return hashes of values of ``fields`` loaded into ``instance``. Deferred
+    fields and attributes other than field values are left out.
+
+    >>> class Consumer(object):
+    ...     def __init__(self, **kwargs):
+    ...         self.__dict__.update(kwargs)
+    >>> hashes = get_field_hashes(Consumer(title='qwf'), ('title', 'body'))
+    >>> hashes.keys()
+    ['title']
+    >>> hashes == get_field_hashes(Consumer(title=u'qwf'), ('title',))
+    True
+    """
+    return dict(
+        (field, hashlib.md5(
+            to_unicode(instance.__dict__[field]).encode('utf-8')).digest())
+        for field in fields if field in instance.__dict__)
+
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def make_cursor(obj):
+    """
+    Return cursor pointing at ``obj`` for ``paginate_by_cursor``.
+    """
+    return '%s_%s' % (obj.date_joined.strftime(CURSOR_FORMAT), obj.pk)
+
+
+def parse_cursor(cursor):
+    """
+    Return date and primary key encoded in a cursor. Raise ValueError if it
+    is malformed.
+
+    >>> parse_cursor('20140328220401000015_42')
+    (datetime.datetime(2014, 3, 28, 22, 4, 1, 15), 42)
+    """
+    date, pk = cursor.split('_')
+    return datetime.datetime.strptime(date, CURSOR_FORMAT), int(pk)
+
+
+def paginate_by_cursor(queryset, query, per_page, count_limit=None):
+    """
+    Return a page of ``queryset`` objects ordered by ``date_joined`` and
+    primary key descending, which follows the ``before`` or precedes the
+    ``after`` cursor from ``query`` (i.e. request.GET). Unlike offset
+    pagination it costs the same for every page.
+    """
+    before, after = query.get('before'), query.get('after')
+    if after:
+        date, pk = parse_cursor(after)
+        object_list = list(queryset.filter(
+            Q(date_joined__gt=date) | Q(date_joined=date, pk__gt=pk)
+            ).order_by('date_joined', 'pk')[:per_page + 1])
+        has_previous = len(object_list) > per_page
+        object_list = object_list[:per_page][::-1]
+        has_next = bool(object_list)
+    else:
+        objects = queryset.order_by('-date_joined', '-pk')
+        if before:
+            date, pk = parse_cursor(before)
+            objects = objects.filter(
+                Q(date_joined__lt=date) | Q(date_joined=date, pk__lt=pk))
+        object_list = list(objects[:per_page + 1])
+        has_next = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        has_previous = bool(before)
+    return CursorPage(
+        object_list, queryset, query, has_next, has_previous, count_limit)
+
+
+class CursorPage(object):
+    """
+    Page returned by ``paginate_by_cursor``. Total count is only computed
+    when asked for, and is capped by ``count_limit`` if it is set. Cursors of
+    neighbour pages are taken from the paginated objects, so they stay valid
+    if ``object_list`` is replaced.
+    """
+    def __init__(
+            self, object_list, queryset, query, has_next, has_previous,
+            count_limit=None):
+        self.object_list = object_list
+        self.first_cursor = object_list and make_cursor(object_list[0])
+        self.last_cursor = object_list and make_cursor(object_list[-1])
+        self.queryset = queryset
+        self.query = query
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.count_limit = count_limit
+        self._count = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def count(self):
+        if self._count is None:
+            if self.count_limit:
+                self._count = len(self.queryset.values_list(
+                    'pk', flat=True)[:self.count_limit])
+            else:
+                self._count = self.queryset.count()
+        return self._count
+
+    def __getstate__(self):
+        # Pickled pages keep their count instead of the queryset.
+        self.count
+        state = self.__dict__.copy()
+        state['queryset'] = None
+        return state
+
+    @property
+    def is_count_approximate(self):
+        return bool(self.count_limit) and self.count >= self.count_limit
+
+    def next_url(self):
+        if self.has_next and self.last_cursor:
+            return self._get_url(before=self.last_cursor)
+
+    def previous_url(self):
+        if self.has_previous:
+            if self.first_cursor:
+                return self._get_url(after=self.first_cursor)
+            return self._get_url()
+
+    def _get_url(self, **cursor):
+        query = self.query.copy()
+        for key in ('before', 'after', 'page'):
+            query.pop(key, None)
+        for key, value in cursor.iteritems():
+            query[key] = value
+        return '?' + query.urlencode()
+
+
+def iter_keyset(queryset, keys, get_values, chunk_size):
+    """
+    Iterate over ``queryset`` ordered by ``keys`` in chunks, each starting
+    after the last object of the previous one.
+    """
+    queryset = queryset.order_by(*keys)
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            values = get_values(last)
+            chunk = chunk.filter(reduce(operator.or_, (
+                Q(**dict(
+                    zip(keys[:i], values[:i]) +
+                    [(keys[i] + '__gt', values[i])]))
+                for i in xrange(len(keys)))))
+        count = 0
+        for obj in chunk[:chunk_size].iterator():
+            count += 1
+            last = obj
+            yield obj
+        if count < chunk_size:
+            break
+
+
 _TIMELINE_FIELDS_DATA = {}
 
 
@@ -302,6 +753,23 @@ def is_observed(model, event):
     return model_data[event]
 
 
+def is_timeline_model(model):
+    return model in _TIMELINE_FIELDS_DATA
+
+
+def get_observed_actions(model):
+    """
+    Return a set of action types observed for timeline of the model.
+
+    >>> sorted(get_observed_actions(
+    ...     observe('app.Model', edit=True, rename=True)))
+    [1, 4]
+    """
+    return frozenset(
+        event for event, is_observed in enumerate(
+            _TIMELINE_FIELDS_DATA.get(model, ())) if is_observed)
+
+
 def get_consumer_filter(key):
     from . import defaults
     action_types = [